@@ -1,6 +1,7 @@
 import logging
 from wagtail_commons.core.management.commands.bootstrap_content import load_attributes_from_file, SiteNode, \
     get_relation_mappings
+from wagtail_commons.core.management.commands.utils import BootstrapError, model_for_type
 import os
 
 from django.conf import settings
@@ -28,10 +29,18 @@ def live_preview(request):
 
     content_attributes = load_attributes_from_file(content_file)
 
-    try:
-        del content_attributes['type']
-    except KeyError:
-        pass
+    content_type = content_attributes.pop('type', None)
+    if content_type:
+        try:
+            page_class = model_for_type(content_type)
+        except BootstrapError as ex:
+            logger.warning("Not previewing %s: %s", content_file, ex)
+            return {}
+
+        if page_class is not page.specific_class:
+            logger.warning("Not previewing %s, its type is %s but the page is a %s", content_file, content_type,
+                           page.specific_class.__name__)
+            return {}
 
     SiteNode.set_page_attributes(page, content_attributes, get_relation_mappings())
 
@@ -4,9 +4,9 @@ import re
 import glob
 import codecs
 import os
-from io import StringIO
 from optparse import make_option
-from collections import ChainMap
+from collections import ChainMap, Counter
+from functools import partial
 
 import yaml, yaml.parser
 import markdown
@@ -14,15 +14,20 @@ import markdown
 from django.core.management.base import BaseCommand, CommandError
 from django.db import models
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
 from django.template import Template, Context, add_to_builtins
+from django.template.base import smart_split
 from django.conf import settings
 
 from wagtail.wagtaildocs.models import Document
 from wagtail.wagtailcore.models import Site, Page
 #from wagtail.wagtailimages.models import get_image_model
 
-from .utils import transformation_for_name, transformation_for_model_field, BootstrapError, image_for_name, render_markdown
+from .utils import transformation_for_name, transformation_for_model_field, BootstrapError, image_for_name, render_markdown, \
+    model_for_type, ReferenceResolver, use_reference_resolver, register_page, unregister_page, prefetched_page, \
+    CommitStrategy, no_transaction, worker_pool
+from .manifest import Manifest, hash_file, hash_documents
+from .hd_parser import parse_document
+from .page_tree import BulkPageInserter, BulkPublisher, wipe_page_tree, write_related_objects
 
 try:
     from wagtail.wagtailimages.models import get_upload_to
@@ -39,13 +44,45 @@ logger = logging.getLogger('wagtail_commons.core')
 
 
 def get_page_type_class(content_type):
-    (app_label, model) = content_type.split('.')
-    page_type = ContentType.objects.get(app_label=app_label, model=model.lower())
-    return page_type.model_class()
+    return model_for_type(content_type)
+
+
+def check_page_types(content_root, page_property_defaults=None):
+    """
+    Resolves the type of every page in the tree, before anything is written, and returns a list of
+    (full path, error message) pairs for those which aren't page models.
+    """
+    if not page_property_defaults:
+        page_property_defaults = dict()
+
+    errors = []
+    for node in content_root.walk():
+        if not node.page_properties or node is content_root:
+            continue
+
+        content_type = node.page_properties.get('type', page_property_defaults.get('type'))
+        try:
+            page_class = get_page_type_class(content_type)
+        except BootstrapError as ex:
+            errors.append((node.full_path, str(ex)))
+            continue
+
+        if not issubclass(page_class, Page):
+            errors.append((node.full_path, "'{0}' is not a page type".format(content_type)))
+
+    return errors
+
+
+def page_url_path(val):
+    url_path = '/' + val.strip('/') + '/'
+    return '/' if url_path == '//' else url_path
 
 
 def page_for_path(val):
     url_path = '/' + val.strip('/') + '/'
+    page = prefetched_page(url_path)
+    if page is not None:
+        return page
     try:
         return Page.objects.get(url_path=url_path).specific
     except Page.DoesNotExist:
@@ -81,91 +118,254 @@ def get_relation_mappings(content_root_path=None):
     return parse_file(content_root_path, 'relations.yml')
 
 
-def document_extractor(f):
-    delimiter = u'---'
-    line = next(f).rstrip(u'\n\r')
+def load_attributes_from_file(path, render=True):
+    """
+    Returns the front matter of the content file at path, with each section added under its name. Sections are
+    rendered to HTML unless render is False; rendering runs template tags, which may query the database.
+    """
+    with codecs.open(path, encoding='utf-8') as f:
+        document = parse_document(f)
+        content_attributes = document.front_matter
 
-    assert delimiter == line, \
-        "Malformed input in{0}\n: Line {1}\nExpected first line to only contain '{2}'".format(f, line, delimiter)
+        for key, body in document.sections():
+            content_attributes[key] = render_markdown(body) if render else body
 
-    contents = dict()
-    key = None
+    return content_attributes
 
-    for line in f:
-        if line[0:3] == delimiter:
-            tokens = line.split()
 
-            if len(tokens) == 2 and tokens[1][0] == '@':
-                key = tokens[1][1:]
-                contents[key] = StringIO()
-                continue
+def find_content_files(content_directory_path):
+    """
+    Returns the .yml files beneath content_directory_path in the order in which their pages are created:
+    the sorted files of a directory first, followed by those of each of its sub-directories.
+    """
+    content_directory_path = os.path.abspath(content_directory_path)
+    contents_paths = sorted(glob.glob("{0}/*.yml".format(content_directory_path)))
 
-        if key:
-            unix_line = line.replace('\r\n', '\n')
-            contents[key].write(unix_line)
+    sub_directories = [os.path.join(content_directory_path, name) for name in os.listdir(content_directory_path)
+                       if os.path.isdir(os.path.join(content_directory_path, name))]
 
-    return contents
+    for directory in sub_directories:
+        contents_paths = contents_paths + find_content_files(directory)
 
+    return contents_paths
 
-def load_attributes_from_file(path):
-    f = codecs.open(path, encoding='utf-8')
-    stream = yaml.load_all(f)
-    content_attributes = next(stream)
-    stream.close()
-    f.seek(0)
-    documents = document_extractor(f)
-    f.close()
 
-    for key in documents:
-        content_attributes[key] = render_markdown(documents[key].getvalue())
+numeric_prefix_regex = re.compile(r'(?:\d+\s+)?(.*)')  # used to strip numbers from start of file, e.g., 001 sample.yml -> sample.yml
+
+
+def computed_path_for_file(path, content_root_path):
+    computed_path = path[len(content_root_path):-4].strip('/')  # get the bare slug
+
+    # break apart the path so we can remove leading digits from the final component
+    path_components = computed_path.split('/')
+    normalized_base_path = numeric_prefix_regex.search(path_components[-1]).group(1)
+    path_components[-1] = normalized_base_path
+    computed_path = '/'.join(path_components)
+    return '/' + computed_path + '/'  # normalize by surrounding with /
 
-    return content_attributes
 
+def load_content(content_directory_path, content_root_path=None, jobs=1, render=True):
+    """
+    Returns a list of (source file, page attributes) tuples, one for each .yml file found beneath
+    content_directory_path, in the order in which the pages should be created. With render=False, sections are
+    left as they were written (see load_attributes_from_file).
 
-def load_content(content_directory_path, content_root_path=None):
+    With jobs > 1 the files are parsed (and their markdown rendered) by a pool of that many worker processes
+    (see worker_pool).
+    """
     content_directory_path = os.path.abspath(content_directory_path)
     if content_root_path:
         content_root_path = os.path.abspath(content_root_path)
     else:
         content_root_path = content_directory_path
 
-    contents_paths = sorted(glob.glob("{0}/*.yml".format(content_directory_path)))
+    contents_paths = find_content_files(content_directory_path)
+
+    if jobs and jobs > 1 and len(contents_paths) > 1:
+        with worker_pool(jobs) as executor:
+            chunk_size = max(1, len(contents_paths) // (jobs * 4))
+            parsed_contents = list(executor.map(partial(load_attributes_from_file, render=render), contents_paths,
+                                                chunksize=chunk_size))
+    else:
+        parsed_contents = [load_attributes_from_file(path, render=render) for path in contents_paths]
 
-    p = re.compile(r'(?:\d+\s+)?(.*)')  # used to strip numbers from start of file, e.g., 001 sample.yml -> sample.yml
     contents = []
+    for path, content_attributes in zip(contents_paths, parsed_contents):
+        if not 'path' in content_attributes:
+            content_attributes['path'] = computed_path_for_file(path, content_root_path)
 
-    for path in contents_paths:
+        contents.append((path, content_attributes))
 
-        content_attributes = load_attributes_from_file(path)
+    return contents
 
-        if not 'path' in content_attributes:
-            computed_path = path[len(content_root_path):-4].strip('/')  # get the bare slug
 
-            # break apart the path so we can remove leading digits from the final component
-            path_components = computed_path.split('/')
-            normalized_base_path = p.search(path_components[-1]).group(1)
-            path_components[-1] = normalized_base_path
-            computed_path = '/'.join(path_components)
-            computed_path = '/' + computed_path + '/'  # normalize by surrounding with /
-            content_attributes['path'] = computed_path
+def interpolate(page, index, doc, val):
+    if "$page" == val:
+        return page
+    if "$index" == val:
+        return index
+    if "$doc" == val:
+        return doc
+    return val
 
-        contents.append(content_attributes)
 
-    sub_directories = [os.path.join(content_directory_path, name) for name in os.listdir(content_directory_path)
-                       if os.path.isdir(os.path.join(content_directory_path, name))]
+NO_RELATION_MAPPINGS = {}
 
-    for directory in sub_directories:
-        contents = contents + load_content(content_directory_path=directory,
-                                           content_root_path=content_root_path)
 
-    return contents
+class AttributePlan(object):
+    """
+    How to assign one key of a page definition to a page of a given class, given the relation mappings. All
+    of the introspection (parsing the key, looking up the field, choosing a transformation) is done once, when
+    the plan is made, and the plan is then reused for every page of that class.
 
+    Plans are cached per page class for the relation mappings most recently passed to plans_for; different
+    mappings (live_preview loads relations.yml again on every request, and it may have changed) start a new cache.
+    Callers without mappings pass NO_RELATION_MAPPINGS, so that they share one cache.
+    """
 
-class SiteNode:
     attribute_regex = re.compile(r'(\w*)(?:\[(\w*)\])?')
 
-    def __init__(self, full_path, page_properties=None, parent_page=None):
-        self.children = []
+    cache = {}
+    cache_mappings = None
+
+    @classmethod
+    def plans_for(cls, page_class, relation_mappings):
+        if relation_mappings is not cls.cache_mappings and relation_mappings != cls.cache_mappings:
+            cls.cache = {}
+            cls.cache_mappings = relation_mappings
+        return cls.cache.setdefault(page_class, {})
+
+    def __init__(self, page_class, attr, relation_mappings):
+        self.attr = attr
+        self.field_name, self.index = self.attribute_regex.search(attr).groups()
+
+        (field_object, model, direct, m2m) = page_class._meta.get_field_by_name(self.field_name)
+        page_data_mappings = relation_mappings.get(str(page_class.__name__), {})
+
+        if direct:
+            if isinstance(field_object, models.ForeignKey):
+                self.transformation = transformation_for_model_field(page_class, attr, page_data_mappings)
+                self.apply = self.apply_foreign_key
+            else:  # we don't yet support a way of setting a one-to-one here
+                self.apply = self.apply_value
+
+        # It's a relation, there are two supported syntaxes
+        else:
+            self.model = field_object.model
+            self.mappings = relation_mappings.get(str(self.model.__name__), dict())
+
+            # @-notation was used, so this is a markdown-rendered text field. index is the subfield, doc is the text
+            if self.index:
+                self.apply = self.apply_indexed_relation
+            # This relation is defined as basic YAML, without any markdown rendering
+            else:
+                self.related_transformations = {}
+                self.apply = self.apply_relation
+
+    def references(self, doc):
+        """
+        Yields a (transformation, value) pair for each value of doc which will be looked up when it's assigned.
+        """
+        if self.apply == self.apply_foreign_key:
+            yield self.transformation, doc
+
+        elif self.apply == self.apply_relation:
+            for related_object in doc:
+                for related_object_attribute, related_object_value in related_object.items():
+                    related_object_attribute = related_object_attribute.lstrip('$')
+                    try:
+                        t = self.related_transformation(related_object_attribute)
+                    except Exception:
+                        continue  # reported when the relation is assigned
+                    yield t, related_object_value
+
+    def apply_value(self, page, doc, deferred_relations):
+        setattr(page, self.attr, doc)
+
+    def apply_foreign_key(self, page, doc, deferred_relations):
+        try:
+            v = self.transformation(doc)
+            logger.debug("%s for %s gets transformed to %s", doc, page, v)
+
+        except BootstrapError:
+            logger.debug("%s for %s has no transformation", doc, page.url_path)
+            v = None
+
+        setattr(page, self.attr, v)
+
+    def clear_indexed_relation(self, page, delete=False):
+        """
+        Removes the objects a previous import added to an existing page's indexed relation, so that updating the
+        page replaces its @field[index] sections rather than adding to them. A modelcluster relation is only
+        cleared in memory (the old objects are deleted if and when the page is saved); any other relation is
+        only cleared with delete=True, since that deletes its objects there and then.
+        """
+        relation = getattr(page, self.field_name)
+        if hasattr(relation, 'commit'):
+            setattr(page, self.field_name, [])
+        elif delete:
+            relation.all().delete()
+
+    def apply_indexed_relation(self, page, doc, deferred_relations):
+        relation = getattr(page, self.field_name)
+        create_attrs = {name: interpolate(page, self.index, doc, val) for name, val in self.mappings.items()}
+        relation.add(self.model(**create_attrs))
+
+    def related_transformation(self, related_object_attribute):
+        try:
+            return self.related_transformations[related_object_attribute]
+        except KeyError:
+            t = transformation_for_model_field(self.model, related_object_attribute, self.mappings)
+            self.related_transformations[related_object_attribute] = t
+            return t
+
+    def apply_relation(self, page, doc, deferred_relations):
+        mappings = self.mappings
+
+        # The doc is a list of serialized models
+        related_objects = []
+
+        defer_assignment = False
+        for related_object in doc:
+
+            common_keys = set(mappings).intersection(related_object)
+            create_attrs = {}
+            for k in common_keys:
+                create_attrs[k] = interpolate(page, self.index, doc, mappings[k])
+
+            for related_object_attribute, related_object_value in related_object.items():
+                # We use a $ on the field name or in the mapping directive to indicate deferred instatiation,
+                # as a simple way of managing dependencies (can't link to page that doesn't yet exist)
+                if '$' == related_object_attribute[0]:
+                    defer_assignment = True
+                    related_object_attribute = related_object_attribute[1:]
+
+                mapping_directive = create_attrs.get(related_object_attribute, None)
+
+                if isinstance(mapping_directive, str):
+                    defer_assignment = '$' == mapping_directive[0]  # this object can't be instantiated yet
+                else:
+                    defer_assignment = True
+
+                if not defer_assignment:
+                    related_object_value = self.related_transformation(related_object_attribute)(related_object_value)
+
+                create_attrs[related_object_attribute] = related_object_value
+
+            related_objects.append(create_attrs)
+
+        if defer_assignment:
+            deferred_relations.append((page, self.attr, related_objects))
+        else:
+            setattr(page, self.attr, [self.model(**create_attrs) for create_attrs in related_objects])
+
+
+class SiteNode:
+    attribute_regex = AttributePlan.attribute_regex
+
+    def __init__(self, full_path, page_properties=None, parent_page=None, source_path=None):
+        self.children = []  # in sibling order
+        self.children_by_slug = {}
         self.full_path = full_path.rstrip('/') + '/'
         last_component_index = self.full_path[0:-1].rfind('/')
         self.slug = self.full_path[last_component_index + 1:-1]
@@ -175,11 +375,19 @@ class SiteNode:
         self.parent_page = parent_page
         self.page = None
         self.deferred_relations = []
+        self.source_path = source_path
+        self.failed = False
 
     def __str__(self):
         return self.full_path
 
-    def add_node(self, new_node):
+    def add_child_node(self, node, nodes_by_path=None):
+        self.children.append(node)
+        self.children_by_slug[node.slug] = node
+        if nodes_by_path is not None:
+            nodes_by_path[node.full_path] = node
+
+    def add_node(self, new_node, nodes_by_path=None):
         # we only care about the part of the new node's path that is not a prefix of this node's path
         assert 0 == new_node.full_path.find(self.full_path), "Trying to add a node which is not a proper descendent"
         assert len(new_node.full_path) >= len(self.full_path), "New node too short to be placed here: {0} vs. {1}". \
@@ -187,151 +395,68 @@ class SiteNode:
 
         if new_node.full_path == self.full_path:
             self.page_properties = new_node.page_properties
+            self.source_path = new_node.source_path
             return
 
         remainder_path = new_node.full_path[len(self.full_path):]
         remainder_path = '/' + remainder_path.strip('/') + '/'
         this_node_slug = remainder_path[1:remainder_path.find('/', 1)]
 
-        ancestor = [child for child in self.children if child.slug == this_node_slug]
+        ancestor = self.children_by_slug.get(this_node_slug)
 
         if ancestor:
-            assert len(ancestor) == 1, "Siblings with same slug?"
-            ancestor[0].add_node(new_node)
+            ancestor.add_node(new_node, nodes_by_path)
         else:
             if remainder_path.strip('/') == this_node_slug:  # leaf node
-                self.children.append(new_node)
+                self.add_child_node(new_node, nodes_by_path)
             else:
                 intermediate_node = SiteNode(full_path=self.full_path + this_node_slug)
-                self.children.append(intermediate_node)
-                intermediate_node.add_node(new_node)
+                self.add_child_node(intermediate_node, nodes_by_path)
+                intermediate_node.add_node(new_node, nodes_by_path)
 
     @staticmethod
-    def set_page_attributes(page, page_properties, relation_mappings=None):
-
-        def interpolate(page, index, doc, val):
-            if "$page" == val:
-                return page
-            if "$index" == val:
-                return index
-            if "$doc" == val:
-                return doc
-            return val
+    def set_page_attributes(page, page_properties, relation_mappings=None, saving=False):
+        """
+        Assigns page_properties to page, returning its deferred relations. Pass saving=True when the page is
+        about to be saved, rather than just previewed or dry run, so that the old objects of its indexed
+        relations may be deleted.
+        """
 
         if not relation_mappings:
-            relation_mappings = dict()
+            relation_mappings = NO_RELATION_MAPPINGS
 
         deferred_relations = []
-        page_data_mappings = relation_mappings.get(str(page.__class__.__name__), {})
+        plans = AttributePlan.plans_for(page.__class__, relation_mappings)
+        cleared_relations = set()
 
         for attr, doc in page_properties.items():
-            field_name, index = SiteNode.attribute_regex.search(attr).groups()
-
-            # This is a relation, they payload (doc) should be a list of related model instances to deserialize
-            field = getattr(page, field_name)
-            (field_object, model, direct, m2m) = page._meta.get_field_by_name(field_name)
-
-            if direct:
-                if isinstance(field_object, models.ForeignKey):
-                    #attr_mapper = page_data_mappings[attr]
-
-                    t = transformation_for_model_field(page, attr, page_data_mappings)
-                    try:
-                        v = t(doc)
-                        print("{} for {} gets transformed to {}".format(doc, page, v))
-
-                    except BootstrapError:
-                        print("{} for {} has no transformation".format(doc, page.url_path))
-                        v = None
-
-                    setattr(page, attr, v)
-
-
-                else:  # we don't yet support a way of setting a one-to-one here
-                    setattr(page, attr, doc)
-
-            # It's a relation, there are two supported syntaxes
-            else:
-                relation = field
-                model = relation.model
-                mappings = relation_mappings.get(str(model.__name__), dict())
-
-                # @-notation was used, so this is a markdown-rendered text field. index is the subfield, doc is the text
-                if index:
-                    create_attrs = {name: interpolate(page, index, doc, val) for name, val in mappings.items()}
-                    relation.add(model(**create_attrs))
-
-                # This relation is defined as basic YAML, without any markdown rendering
-                else:
-                    # The doc is a list of serialized models
-                    related_objects = []
-
-                    defer_assignment = False
-                    for related_object in doc:
-
-                        common_keys = set(mappings).intersection(related_object)
-                        create_attrs = {}
-                        for k in common_keys:
-                            create_attrs[k] = interpolate(page, index, doc, mappings[k])
-
-                        for related_object_attribute, related_object_value in related_object.items():
-                            # We use a $ on the field name or in the mapping directive to indicate deferred instatiation,
-                            # as a simple way of managing dependencies (can't link to page that doesn't yet exist)
-                            if '$' == related_object_attribute[0]:
-                                defer_assignment = True
-                                related_object_attribute = related_object_attribute[1:]
-
-
-                            mapping_directive = create_attrs.get(related_object_attribute, None)
-
-                            if isinstance(mapping_directive, str):
-                                defer_assignment = '$' == mapping_directive[0]  # this object can't be instantiated yet
-                            else:
-                                defer_assignment = True
-
-                            if not defer_assignment:
-                                t = transformation_for_model_field(model, related_object_attribute, mappings)
-                                related_object_value = t(related_object_value)
-
-                            create_attrs[related_object_attribute] = related_object_value
-
-                        # for rel_doc in create_attrs.values():
-                        #     print "Checking {}".format(rel_doc)
-                        #     if isinstance(rel_doc, str):
-                        #         defer_assignment = defer_assignment or '$' == rel_doc[0]
-
-                        related_objects.append(create_attrs)
+            try:
+                plan = plans[attr]
+            except KeyError:
+                plan = plans[attr] = AttributePlan(page.__class__, attr, relation_mappings)
 
-                    if defer_assignment:
-                        deferred_relations.append((page, attr, related_objects))
-                        #model=page, rel_name=attr, create_attrs_list=related_objects)
-                    else:
-                        related_models = []
-                        for create_attrs in related_objects:
-                            related_models.append(model(**create_attrs))
+            if plan.apply == plan.apply_indexed_relation and page.pk is not None and \
+                    plan.field_name not in cleared_relations:
+                plan.clear_indexed_relation(page, delete=saving)
+                cleared_relations.add(plan.field_name)
 
-                        setattr(page, attr, related_models)
+            plan.apply(page, doc, deferred_relations)
 
         return deferred_relations
 
 
-    def instantiate_page(self, owner_user,
-                         page_property_defaults=None,
-                         relation_mappings=None,
-                         dry_run=True):
-
+    def get_page_properties(self, page_property_defaults=None):
         if not page_property_defaults:
             page_property_defaults = dict()
 
-        if not relation_mappings:
-            relation_mappings = dict()
-
         page_properties = dict(page_property_defaults, **self.page_properties)
         page_class = get_page_type_class(page_properties['type'])
         page_properties.pop('type', None)
         page_properties.pop('path', None)
 
-        page = page_class(owner=owner_user)
+        return page_class, page_properties
+
+    def populate_page(self, page, page_properties, relation_mappings, saving=False):
         page.live = True
         page.has_unpublished_changes = False
         page.locked = False
@@ -344,35 +469,176 @@ class SiteNode:
         except KeyError:
             raise KeyError("{full_path} is missing the 'title' property".format(full_path=self.full_path))
 
-        self.deferred_relations = self.set_page_attributes(page, page_properties, relation_mappings=relation_mappings)
+        self.deferred_relations = self.set_page_attributes(page, page_properties, relation_mappings=relation_mappings,
+                                                           saving=saving)
+
+    def instantiate_page(self, owner_user,
+                         page_property_defaults=None,
+                         relation_mappings=None,
+                         dry_run=True,
+                         sync=None,
+                         bulk=None,
+                         publisher=None,
+                         commits=None):
+
+        if not relation_mappings:
+            relation_mappings = NO_RELATION_MAPPINGS
+
+        page_class, page_properties = self.get_page_properties(page_property_defaults)
+
+        page = page_class(owner=owner_user)
+        self.populate_page(page, page_properties, relation_mappings)
 
-        if not dry_run:
+        if bulk:
+            bulk.add_child(self.parent_page, page)
+            self.publish_page(page, publisher)
+        elif not dry_run:
             self.parent_page.add_child(instance=page)
             page.save()
-            page.save_revision(submitted_for_moderation=False).publish()
+            self.publish_page(page, publisher)
+            if commits:
+                commits.tick()
 
         self.page = page
+        register_page(self.full_path, page)
+
+        if sync:
+            sync.increment_stat('created')
+
+        self.instantiate_children(owner_user, page_property_defaults, relation_mappings, dry_run, sync, bulk,
+                                  publisher, commits)
+
+        return self.page
+
+    @staticmethod
+    def publish_page(page, publisher=None):
+        if publisher:
+            publisher.add(page)
+        else:
+            page.save_revision(submitted_for_moderation=False).publish()
 
+    def instantiate_children(self, owner_user, page_property_defaults, relation_mappings, dry_run, sync, bulk=None,
+                             publisher=None, commits=None):
         for child in self.children:
             child.parent_page = self.page
             try:
-                child.instantiate_page(owner_user=owner_user, page_property_defaults=page_property_defaults,
-                                       dry_run=dry_run, relation_mappings=relation_mappings)
+                child.instantiate_subtree(owner_user, page_property_defaults, relation_mappings, dry_run, sync, bulk,
+                                          publisher, commits)
             except Exception as ex:
+                if commits and not commits.skips_failed_subtrees:
+                    raise
+                child.discard_subtree(publisher)
+                if sync:
+                    sync.subtree_failed(child)
                 print(traceback.format_exc())
                 print("This exception was thrown while trying to process {full_path}, with properties {properties}".
                       format(full_path=child.full_path, properties=child.page_properties))
 
+    def discard_subtree(self, publisher=None):
+        """
+        Marks this node and its descendants as failed, once their savepoint has been rolled back, and forgets the
+        pages they had instantiated: those rows no longer exist, so nothing may link to, relate to or publish them.
+        """
+        pages = []
+        for node in self.walk():
+            if node.page is not None:
+                pages.append(node.page)
+                unregister_page(node.full_path)
+            node.page = None
+            node.deferred_relations = []
+            node.failed = True
+
+        if publisher:
+            publisher.discard(pages)
+
+    def instantiate_subtree(self, owner_user, page_property_defaults, relation_mappings, dry_run, sync, bulk=None,
+                            publisher=None, commits=None):
+        # a failed subtree is rolled back to a savepoint when the commit strategy allows skipping it
+        with commits.subtree() if commits else no_transaction():
+            if sync:
+                self.update_page(owner_user=owner_user, sync=sync, page_property_defaults=page_property_defaults,
+                                 dry_run=dry_run, relation_mappings=relation_mappings, publisher=publisher,
+                                 commits=commits)
+            else:
+                self.instantiate_page(owner_user=owner_user, page_property_defaults=page_property_defaults,
+                                      dry_run=dry_run, relation_mappings=relation_mappings, bulk=bulk,
+                                      publisher=publisher, commits=commits)
+
+    def update_page(self, owner_user, sync,
+                    page_property_defaults=None,
+                    relation_mappings=None,
+                    dry_run=True,
+                    publisher=None,
+                    commits=None):
+        """
+        Like instantiate_page, but reuses the page already in the database at this node's url path (or the one
+        this node's content file was previously imported to), so that its id and revision history are kept.
+        Only pages whose content file has changed since the last run are rewritten.
+        """
+
+        if not relation_mappings:
+            relation_mappings = NO_RELATION_MAPPINGS
+
+        page = sync.find_existing_page(self)
+        if page is None:
+            return self.instantiate_page(owner_user=owner_user, page_property_defaults=page_property_defaults,
+                                         relation_mappings=relation_mappings, dry_run=dry_run, sync=sync,
+                                         publisher=publisher, commits=commits)
+
+        page_class, page_properties = self.get_page_properties(page_property_defaults)
+        page = page.specific
+
+        if page.specific_class is not page_class:
+            logger.info("%s changed type from %s to %s, replacing it", self.full_path,
+                        page.specific_class.__name__, page_class.__name__)
+            if not dry_run:
+                page.delete()
+            sync.forget_page(page)
+            return self.instantiate_page(owner_user=owner_user, page_property_defaults=page_property_defaults,
+                                         relation_mappings=relation_mappings, dry_run=dry_run, sync=sync,
+                                         publisher=publisher, commits=commits)
+
+        if page.url_path != self.full_path:
+            logger.info("Moving %s to %s", page.url_path, self.full_path)
+            if not dry_run:
+                page.move(self.parent_page, pos='last-child')
+                page = Page.objects.get(id=page.id).specific
+            sync.increment_stat('moved')
+
+        if sync.has_changed(self) or page.url_path != self.full_path:
+            self.populate_page(page, page_properties, relation_mappings, saving=not dry_run)
+            if not dry_run:
+                page.save()
+                self.publish_page(page, publisher)
+                if commits:
+                    commits.tick()
+            sync.increment_stat('updated')
+        else:
+            sync.increment_stat('unchanged')
+
+        self.page = page
+        register_page(self.full_path, page)
+
+        self.instantiate_children(owner_user, page_property_defaults, relation_mappings, dry_run, sync,
+                                  publisher=publisher, commits=commits)
+
         return self.page
 
+    def walk(self):
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
 
-    def instantiate_deferred_models(self, owner_user,
-                                    page_property_defaults=None,
-                                    relation_mappings=None,
-                                    dry_run=True):
+    def build_deferred_models(self, relation_mappings, transformations):
+        """
+        Returns (page, relation name, relation field, related objects) for each of this node's deferred relations,
+        with every attribute of the related objects transformed. transformations caches the transformation
+        of each (model, attribute) across the whole tree.
+        """
+        deferred_models = []
 
         for (page, relation_name, objects) in self.deferred_relations:
-            field = getattr(page, relation_name)
             (field_object, _, _, _) = page._meta.get_field_by_name(relation_name)
             model = field_object.model
             model_mapper = relation_mappings.get(model.__name__, {})
@@ -383,7 +649,11 @@ class SiteNode:
 
                 for attr, val in object.items():
                     try:
-                        transformation = transformation_for_model_field(model, attr, model_mapper)
+                        try:
+                            transformation = transformations[(model, attr)]
+                        except KeyError:
+                            transformation = transformation_for_model_field(model, attr, model_mapper)
+                            transformations[(model, attr)] = transformation
                         setattr(new_obj, attr, transformation(val))
 
                     except BootstrapError as bex:
@@ -395,36 +665,320 @@ class SiteNode:
 
                 related_objects.append(new_obj)
 
-            setattr(page, relation_name, related_objects)
-            page.save()
-            page.save_revision(submitted_for_moderation=False).publish()
+            deferred_models.append((page, relation_name, field_object, related_objects))
 
-        for child in self.children:
-            child.instantiate_deferred_models(owner_user,
-                                              page_property_defaults=None,
-                                              relation_mappings=relation_mappings,
-                                              dry_run=dry_run)
+        return deferred_models
+
+    def instantiate_deferred_models(self, owner_user,
+                                    page_property_defaults=None,
+                                    relation_mappings=None,
+                                    dry_run=True,
+                                    publisher=None,
+                                    batch_size=500):
+        """
+        Creates the deferred relations of this node and all of its descendants: the related objects of the whole
+        subtree are built first, then written with a batched insert per related model, and then each affected
+        page gets a single new revision.
+        """
+
+        if not relation_mappings:
+            relation_mappings = NO_RELATION_MAPPINGS
+
+        transformations = {}
+        deferred_models = []
+        for node in self.walk():
+            deferred_models.extend(node.build_deferred_models(relation_mappings, transformations))
+
+        if not deferred_models:
+            return
+
+        write_related_objects(deferred_models, batch_size=batch_size)
+
+        affected_pages = []
+        seen = set()
+        for page, _, _, _ in deferred_models:
+            if id(page) not in seen:
+                seen.add(id(page))
+                affected_pages.append(page)
+
+        for page in affected_pages:
+            self.publish_page(page, publisher)
 
 
 class RootNode(SiteNode):
+    """
+    The top of the tree. Besides the children of every node, it indexes each node in the tree by full_path,
+    so nodes can be found, and added beneath an existing parent, without walking down to them.
+    """
+
+    def __init__(self, full_path, page_properties=None, parent_page=None, source_path=None):
+        super(RootNode, self).__init__(full_path, page_properties=page_properties, parent_page=parent_page,
+                                       source_path=source_path)
+        self.nodes_by_path = {self.full_path: self}
+
+    def find_node(self, full_path):
+        return self.nodes_by_path.get(full_path.rstrip('/') + '/')
+
+    def add_node(self, new_node, nodes_by_path=None):
+        existing_node = self.nodes_by_path.get(new_node.full_path)
+        if existing_node is not None:
+            existing_node.page_properties = new_node.page_properties
+            existing_node.source_path = new_node.source_path
+            return
+
+        parent_path = new_node.full_path[0:new_node.full_path[0:-1].rfind('/') + 1]
+        parent_node = self.nodes_by_path.get(parent_path, self)
+        if parent_node is self:
+            SiteNode.add_node(self, new_node, self.nodes_by_path)
+        else:
+            parent_node.add_node(new_node, self.nodes_by_path)
+
     def instantiate_page(self, owner_user,
                          page_property_defaults=None,
                          relation_mappings=None,
-                         dry_run=True):
+                         dry_run=True,
+                         sync=None,
+                         bulk=None,
+                         publisher=None,
+                         commits=None):
         for child in self.children:
             child.parent_page = self.parent_page
-            child.instantiate_page(owner_user=owner_user, page_property_defaults=page_property_defaults,
-                                   dry_run=dry_run, relation_mappings=relation_mappings)
+            child.instantiate_subtree(owner_user, page_property_defaults, relation_mappings, dry_run, sync, bulk,
+                                      publisher, commits)
 
-    def instantiate_deferred_models(self, owner_user,
-                                    page_property_defaults=None,
-                                    relation_mappings=None,
-                                    dry_run=True):
-        for child in self.children:
-            child.instantiate_deferred_models(owner_user,
-                                              page_property_defaults=page_property_defaults,
-                                              relation_mappings=relation_mappings,
-                                              dry_run=dry_run)
+
+def collect_references(content_root, resolver, page_property_defaults=None, relation_mappings=None):
+    """
+    Adds every image, document and natural-key reference made by the pages in the tree to resolver.
+    """
+    if not relation_mappings:
+        relation_mappings = NO_RELATION_MAPPINGS
+
+    for node in content_root.walk():
+        if not node.page_properties or node is content_root:
+            continue
+
+        page_class, page_properties = node.get_page_properties(page_property_defaults)
+        plans = AttributePlan.plans_for(page_class, relation_mappings)
+
+        for attr, doc in page_properties.items():
+            try:
+                plan = plans[attr]
+            except KeyError:
+                try:
+                    plan = plans[attr] = AttributePlan(page_class, attr, relation_mappings)
+                except Exception:
+                    continue  # reported when the page is instantiated
+
+            for transformation, val in plan.references(doc):
+                resolver.add(transformation, val, source=node.full_path)
+
+
+template_tag_regex = re.compile(r'\{%\s*(image|page)\s+(.+?)\s*%\}')
+
+
+def template_tag_references(text):
+    """
+    Yields a (kind, value) pair for each {% image "file name" "format" "alt text" %} and {% page "path" %} tag in
+    text, i.e., for each of our template tags which looks something up in the database.
+    """
+    for match in template_tag_regex.finditer(text):
+        tag_name, args = match.group(1), list(smart_split(match.group(2)))
+        first = args[0]
+        if len(first) < 2 or first[0] != first[-1] or first[0] not in ('"', "'"):
+            continue  # a variable, e.g. wagtailimages' {% image page.photo width-400 %}
+        yield tag_name, first[1:-1]
+
+
+def library_names(library_path):
+    names = set()
+    for dir_path, _, file_names in os.walk(library_path):
+        names.update(file_names)
+    return names
+
+
+def validate_content(content_root, content_path, page_property_defaults=None, relation_mappings=None):
+    """
+    Checks the content tree without touching the database: that every page has a definition, a known page type
+    and a title, that every attribute can be assigned to a page of its type, and that every $path, $image and
+    $document reference points at a page in the tree, or a file in the image or document library. (Natural-key
+    references to other models can't be checked without the database.) Sections should be loaded without
+    rendering them; the image and page template tags in them are checked the same way.
+
+    Returns a list of (full path, error message) pairs.
+    """
+    if not page_property_defaults:
+        page_property_defaults = dict()
+    if not relation_mappings:
+        relation_mappings = NO_RELATION_MAPPINGS
+
+    errors = check_page_types(content_root, page_property_defaults)
+    bad_types = set(full_path for full_path, _ in errors)
+
+    sites = get_sites(content_path)
+    resolver = ReferenceResolver(root_url_path=page_url_path(sites[0]['root_page']) if sites else '/')
+    tree_paths = set(node.full_path for node in content_root.walk() if node.page_properties)
+
+    for site in sites:
+        if page_url_path(site['root_page']) not in tree_paths:
+            errors.append(('sites.yml', "root page {0} of {1} isn't in the content tree".format(
+                site['root_page'], site['hostname'])))
+
+    libraries = {}
+    for kind, directory in (('image', 'image-library'), ('document', 'document-library')):
+        library_path = os.path.join(content_path, directory)
+        libraries[kind] = library_names(library_path) if os.path.isdir(library_path) else None
+
+    for node in content_root.walk():
+        if node is content_root:
+            continue
+
+        if not node.page_properties:
+            errors.append((node.full_path, "has no page definition, but there are pages below it"))
+            continue
+
+        if node.full_path in bad_types:
+            continue
+
+        page_class, page_properties = node.get_page_properties(page_property_defaults)
+        if 'title' not in page_properties:
+            errors.append((node.full_path, "is missing the 'title' property"))
+
+        plans = AttributePlan.plans_for(page_class, relation_mappings)
+        for attr, doc in page_properties.items():
+            if isinstance(doc, str):
+                for kind, val in template_tag_references(doc):
+                    if kind == 'page':
+                        if resolver.url_path_for(val) not in tree_paths:
+                            errors.append((node.full_path, "{0} links to {1}, which isn't in the content tree".
+                                           format(attr, val)))
+                    elif libraries['image'] is not None and os.path.basename(val) not in libraries['image']:
+                        errors.append((node.full_path, "{0} shows image {1}, which isn't in the image library".
+                                       format(attr, val)))
+
+            try:
+                plan = plans[attr]
+            except KeyError:
+                try:
+                    plan = plans[attr] = AttributePlan(page_class, attr, relation_mappings)
+                except Exception as ex:
+                    errors.append((node.full_path, "can't assign {0} to a {1}: {2}".format(
+                        attr, page_class.__name__, ex)))
+                    continue
+
+            if plan.apply == plan.apply_relation and not (isinstance(doc, list) and
+                                                          all(isinstance(item, dict) for item in doc)):
+                errors.append((node.full_path, "{0} should be a list of mappings".format(attr)))
+                continue
+
+            for transformation, val in plan.references(doc):
+                kind = resolver.kind_for_transformation(transformation)
+                if not isinstance(val, str):
+                    continue
+                if kind == 'page':
+                    if resolver.url_path_for(val) not in tree_paths:
+                        errors.append((node.full_path, "{0} links to {1}, which isn't in the content tree".format(
+                            attr, val)))
+                elif kind in libraries:
+                    if libraries[kind] is None:
+                        continue
+                    if os.path.basename(val) not in libraries[kind]:
+                        errors.append((node.full_path, "{0} refers to {1} {2}, which isn't in the {1} library".format(
+                            attr, kind, val)))
+
+    return errors
+
+
+class IncrementalSync(object):
+    """
+    Decides, for each SiteNode, which existing page (if any) it corresponds to and whether its content
+    file has changed since the manifest was written.
+    """
+
+    def __init__(self, manifest, content_root, content_path, settings_hash):
+        self.manifest = manifest
+        self.content_path = content_path
+        self.settings_hash = settings_hash
+        self.settings_changed = manifest.settings_hash != settings_hash
+        self.results = Counter({'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 0, 'deleted': 0})
+        self.failed_paths = set()
+
+        self.existing_pages = {page.url_path: page for page in Page.objects.filter(depth__gt=1)}
+
+        self.tree_paths = set()
+        self.hashes = {}
+        for node in content_root.walk():
+            self.tree_paths.add(node.full_path)
+            if node.source_path:
+                self.hashes[node.full_path] = hash_file(node.source_path)
+
+        # pages which were imported before, but whose url path is no longer in the content tree, may have moved
+        self.moved_by_source = {}
+        self.moved_by_hash = {}
+        for url_path, entry in manifest.entries.items():
+            if url_path not in self.tree_paths:
+                self.moved_by_source[entry['source']] = url_path
+                self.moved_by_hash.setdefault(entry['hash'], url_path)
+
+    def increment_stat(self, stat):
+        self.results.update({stat: 1})
+
+    def relative_source(self, node):
+        return os.path.relpath(node.source_path, self.content_path)
+
+    def has_changed(self, node):
+        entry = self.manifest.get(node.full_path)
+        return self.settings_changed or entry is None or entry['hash'] != self.hashes.get(node.full_path)
+
+    def find_existing_page(self, node):
+        page = self.existing_pages.get(node.full_path)
+        if page is not None or not node.source_path:
+            return page
+
+        old_url_path = self.moved_by_source.pop(self.relative_source(node), None)
+        if old_url_path is None:
+            old_url_path = self.moved_by_hash.pop(self.hashes[node.full_path], None)
+        if old_url_path is None:
+            return None
+
+        page = self.existing_pages.pop(old_url_path, None)
+        if page is not None:
+            self.existing_pages[node.full_path] = page
+        return page
+
+    def subtree_failed(self, node):
+        # rolled back, so the manifest must not claim these pages are up to date
+        self.failed_paths.update(n.full_path for n in node.walk())
+
+    def forget_page(self, page):
+        """
+        Forgets page, and every page below it, once it has been deleted (which deletes its descendants too).
+        """
+        self.existing_pages = {url_path: p for url_path, p in self.existing_pages.items()
+                               if not p.path.startswith(page.path)}
+
+    def delete_stale_pages(self, dry_run=True):
+        stale_paths = []
+        for url_path in sorted(Page.objects.filter(depth__gt=1).values_list('url_path', flat=True), key=len):
+            if url_path in self.tree_paths:
+                continue
+            if any(url_path.startswith(ancestor) for ancestor in stale_paths):
+                continue  # deleted along with its ancestor
+            stale_paths.append(url_path)
+
+        for url_path in stale_paths:
+            logger.info("Deleting %s, it is no longer in the content directory", url_path)
+            if not dry_run:
+                Page.objects.get(url_path=url_path).delete()
+            self.increment_stat('deleted')
+
+    def update_manifest(self, content_root):
+        # pages in failed subtrees are left out, so that has_changed() is true for them and they are retried
+        self.manifest.settings_hash = self.settings_hash
+        self.manifest.entries = {node.full_path: {'source': self.relative_source(node),
+                                                  'hash': self.hashes[node.full_path]}
+                                 for node in content_root.walk()
+                                 if node.source_path and node.full_path not in self.failed_paths}
 
 
 class Command(BaseCommand):
@@ -434,13 +988,29 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--content', dest='content_path', type='string', ),
         make_option('--owner', dest='owner', type='string'),
-        make_option('--dry', dest='dry', action='store_true'),
-    )
-
-    option_list = BaseCommand.option_list + (
-        make_option('--content', dest='content_path', type='string', ),
-        make_option('--owner', dest='owner', type='string'),
-        make_option('--dry', dest='dry', action='store_true'),
+        make_option('--dry', dest='dry', action='store_true',
+                    help='With --incremental, report what would change without changing it; '
+                         'otherwise the same as --validate'),
+        make_option('--validate', dest='validate', action='store_true',
+                    help='Check the content directory, without reading or writing the database'),
+        make_option('--incremental', dest='incremental', action='store_true',
+                    help='Only create, update, move or delete pages whose content changed since the last run'),
+        make_option('--manifest', dest='manifest_path', type='string',
+                    help='Where to keep the manifest used by --incremental, '
+                         'defaults to <content dir>/.bootstrap_content.json'),
+        make_option('--jobs', dest='jobs', type='int', default=1,
+                    help='Number of processes used to parse the content files'),
+        make_option('--bulk', dest='bulk', action='store_true',
+                    help='Insert the page tree in batches instead of one page at a time (full rebuilds only)'),
+        make_option('--bulk-publish', dest='bulk_publish', action='store_true',
+                    help='Write one revision per page, in batches, once all of its relations are resolved '
+                         '(implied by --bulk)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500),
+        make_option('--commit', dest='commit', type='string', default='all',
+                    help='all (the default) to build everything in one transaction, subtree to skip page subtrees '
+                         'which fail, or a number N to commit every N pages'),
+        make_option('--ignore-missing', dest='ignore_missing', action='store_true',
+                    help="Carry on when images, documents or other models referenced by pages don't exist"),
     )
 
     def handle(self, *args, **options):
@@ -452,35 +1022,117 @@ class Command(BaseCommand):
         else:
             raise CommandError("Pass --content <content dir>, where <content dir>/pages contain .yml files")
 
+        dry_run = options['dry']
+        validate = options['validate'] or (dry_run and not options['incremental'])
+
+        # rendering runs template tags, which query the database, so validation checks the unrendered sections
+        contents = load_content(os.path.join(content_path, 'pages'), jobs=options['jobs'], render=not validate)
+
+        content_root = RootNode('/', page_properties={})
+        for source_path, page_attrs in contents:
+            new_node = SiteNode(full_path=page_attrs['path'], page_properties=page_attrs, source_path=source_path)
+            content_root.add_node(new_node)
+
+        page_property_defaults = get_page_defaults(content_path)
+        relation_mappings = get_relation_mappings(content_path)
+
+        if validate:
+            errors = validate_content(content_root, content_path, page_property_defaults, relation_mappings)
+            for full_path, error in errors:
+                self.stderr.write("{0}: {1}".format(full_path, error))
+            if errors:
+                raise CommandError("Found {0} problems in {1} pages".format(len(errors), len(contents)))
+            self.stdout.write("Checked {0} pages, no problems found".format(len(contents)))
+            return
+
         if options['owner']:
             owner_user = User.objects.get(username=options['owner'])
         else:
             owner_user = None
             #raise CommandError("Pass --owner <username>, where <username> will be the content owner")
 
-        dry_run = options['dry']
+        content_root.parent_page = Page.get_first_root_node()
+
+        type_errors = check_page_types(content_root, page_property_defaults)
+        if type_errors:
+            for full_path, error in type_errors:
+                self.stderr.write("{0}: {1}".format(full_path, error))
+            raise CommandError("Found {0} pages with an unknown type, nothing was changed".format(len(type_errors)))
+
+        # both a rebuild and an incremental run delete the pages they don't import, so links to them are missing
+        sites = get_sites(content_path)
+        resolver = ReferenceResolver(root_url_path=page_url_path(sites[0]['root_page']) if sites else '/',
+                                     natural_key_fields=relation_mappings.get('natural_keys'), outside_pages=False)
+        resolver.expect_pages(node.full_path for node in content_root.walk() if node.page_properties)
+        collect_references(content_root, resolver, page_property_defaults, relation_mappings)
+        missing_references = resolver.prefetch()
+        if missing_references:
+            for kind, key, sources in missing_references:
+                self.stderr.write("Missing {0} '{1}', referenced by {2}".format(kind, key, ', '.join(sources)))
+            if not options['ignore_missing']:
+                raise CommandError("Found {0} missing references, nothing was changed".format(
+                    len(missing_references)))
+        use_reference_resolver(resolver)
+
+        if options['incremental'] and options['bulk']:
+            raise CommandError("--bulk only applies to full rebuilds, it can't be combined with --incremental")
+
+        try:
+            commits = CommitStrategy(options['commit'])
+        except BootstrapError as ex:
+            raise CommandError(str(ex))
+
+        # bulk inserted pages are only written by the final flush, so they can't be committed as they go, and
+        # rolling back a failed subtree's savepoint wouldn't take its pages out of the batch
+        if options['bulk'] and commits.mode != CommitStrategy.ALL:
+            raise CommandError("--bulk can only be used with --commit all")
+
+        if (options['bulk'] or options['bulk_publish']) and not dry_run:
+            publisher = BulkPublisher(batch_size=options['batch_size'])
+        else:
+            publisher = None
+
+        with commits.run():
+            if options['incremental']:
+                self.update_content(content_path, content_root, owner_user, page_property_defaults,
+                                    relation_mappings, options['manifest_path'], dry_run, publisher,
+                                    options['batch_size'], commits)
+            else:
+                self.rebuild_content(content_path, content_root, owner_user, page_property_defaults,
+                                     relation_mappings, dry_run, publisher, options['bulk'], options['batch_size'],
+                                     commits)
 
-        contents = load_content(os.path.join(content_path, 'pages'))
+    def report_failed_subtrees(self, content_root):
+        failed_paths = [node.full_path for node in content_root.walk() if node.failed and node.page_properties]
+        if failed_paths:
+            self.stderr.write("Skipped {0} pages in failed subtrees: {1}".format(len(failed_paths),
+                                                                                  ', '.join(failed_paths)))
+
+    def rebuild_content(self, content_path, content_root, owner_user, page_property_defaults, relation_mappings,
+                        dry_run, publisher=None, bulk_insert=False, batch_size=500, commits=None):
 
         for site in Site.objects.all():
             site.delete()
 
-        for page in Page.objects.filter(id__gt=1):
-            page.delete()
-
-        root = Page.get_first_root_node()
-        content_root = RootNode('/', page_properties={}, parent_page=root)
-        for page_attrs in contents:
-            new_node = SiteNode(full_path=page_attrs['path'], page_properties=page_attrs)
-            content_root.add_node(new_node)
+        wipe_page_tree(content_root.parent_page)
 
-        page_property_defaults = get_page_defaults(content_path)
-        relation_mappings = get_relation_mappings(content_path)
+        if bulk_insert and not dry_run:
+            bulk = BulkPageInserter(batch_size=batch_size)
+        else:
+            bulk = None
 
         content_root.instantiate_page(owner_user=owner_user,
                                       page_property_defaults=page_property_defaults,
                                       relation_mappings=relation_mappings,
-                                      dry_run=dry_run)
+                                      dry_run=dry_run,
+                                      bulk=bulk,
+                                      publisher=publisher,
+                                      commits=commits)
+
+        if bulk:
+            bulk.flush()
+
+        self.report_failed_subtrees(content_root)
 
         sites = []
         for site in get_sites(content_path):
@@ -499,6 +1151,57 @@ class Command(BaseCommand):
         content_root.instantiate_deferred_models(owner_user=owner_user,
                                                  page_property_defaults=page_property_defaults,
                                                  relation_mappings=relation_mappings,
-                                                 dry_run=dry_run)
+                                                 dry_run=dry_run,
+                                                 publisher=publisher,
+                                                 batch_size=batch_size)
+
+        if publisher:
+            publisher.flush()
+
+    def update_content(self, content_path, content_root, owner_user, page_property_defaults, relation_mappings,
+                       manifest_path, dry_run, publisher=None, batch_size=500, commits=None):
+
+        if not manifest_path:
+            manifest_path = os.path.join(content_path, '.bootstrap_content.json')
+
+        manifest = Manifest.load(manifest_path)
+        sync = IncrementalSync(manifest, content_root, content_path,
+                               settings_hash=hash_documents(page_property_defaults, relation_mappings))
+
+        content_root.instantiate_page(owner_user=owner_user,
+                                      page_property_defaults=page_property_defaults,
+                                      relation_mappings=relation_mappings,
+                                      dry_run=dry_run,
+                                      sync=sync,
+                                      publisher=publisher,
+                                      commits=commits)
+
+        sync.delete_stale_pages(dry_run=dry_run)
+        self.report_failed_subtrees(content_root)
+
+        results = sync.results
+        self.stdout.write("Created: {0}, updated: {1}, moved: {2}, unchanged: {3}, deleted: {4}".format(
+            results['created'], results['updated'], results['moved'], results['unchanged'], results['deleted']))
+
+        if dry_run:
+            self.stdout.write("Dry run, exiting without making changes")
+            return
+
+        for i, site in enumerate(get_sites(content_path)):
+            Site.objects.update_or_create(hostname=site['hostname'],
+                                          port=int(site['port']),
+                                          defaults={'root_page': page_for_path(site['root_page']),
+                                                    'is_default_site': i == 0})
+
+        content_root.instantiate_deferred_models(owner_user=owner_user,
+                                                 page_property_defaults=page_property_defaults,
+                                                 relation_mappings=relation_mappings,
+                                                 dry_run=dry_run,
+                                                 publisher=publisher,
+                                                 batch_size=batch_size)
 
+        if publisher:
+            publisher.flush()
 
+        sync.update_manifest(content_root)
+        manifest.save()
@@ -1,18 +1,9 @@
 import logging
-from collections import Counter
 from django.conf import settings
-from django.core.files import File
-from wagtail.wagtailimages.models import get_image_model
-
-try:
-    from wagtail.wagtailimages.models import get_upload_to
-except ImportError:
-    def get_upload_to(instance, path):
-        return instance.get_upload_to(path)
+from wagtail.wagtaildocs.models import Document
 
 __author__ = 'brett@codigious.com'
 
-import filecmp
 import os
 
 from optparse import make_option
@@ -20,100 +11,156 @@ from django.contrib.auth.models import User
 
 from django.core.management.base import BaseCommand, CommandError
 
-# <embed alt="urn" embedtype="image" format="right" id="1"/>
+from .utils import CommitStrategy, BootstrapError, index_objects
+from .manifest import Manifest, LibraryManifestMixin
+from .media_files import STORAGE_STRATEGIES, store_file
 
 logger = logging.getLogger(__name__)
 
-class DocumentImporter(object):
 
-    ImageModel = get_image_model()
-    image_instance = ImageModel()
+class DocumentImporter(LibraryManifestMixin):
+
+    DocumentModel = Document
+    document_instance = DocumentModel()
 
-    def __init__(self, path, owner, stdout, stderr):
+    def __init__(self, path, owner, stdout, stderr, commits=None, manifest=None, batch_size=100,
+                 storage_strategy='storage'):
         # TODO remove dependency on stdout/stderr (this is invoked by other management scripts...)
 
         self.library_path = path
         self.owner = owner
         self.stdout = stdout
         self.stderr = stderr
-        self.results = Counter({'total': 0,
-                                'unchanged': 0,
-                                'altered': 0,
-                                'inserted': 0,
-                                'ignored': 0})
+        self.commits = commits
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.storage_strategy = storage_strategy
+        self.source_hashes = {}
+        self.library_index = {}
+        self.new_documents = []
+        self.changed_documents = []
+        self.results = {'total': 0,
+                        'unchanged': 0,
+                        'altered': 0,
+                        'inserted': 0,
+                        'ignored': 0}
 
     def increment_stat(self, stat):
-        self.results.update({stat: 1})
-
-    def import_images(self):
-        self.add_images_to_library(self.library_path)
+        self.results[stat] += 1
+        if self.commits and stat in ('altered', 'inserted'):
+            self.commits.tick()
+
+    def import_documents(self):
+        self.load_library_index()
+        self.add_documents_to_library(self.library_path)
+        self.insert_documents()
+        self.write_changed_documents()
+        if self.manifest:
+            self.manifest.save()
+
+    def file_name(self, path):
+        file_field = self.DocumentModel._meta.get_field('file')
+        return file_field.generate_filename(self.document_instance, os.path.basename(path))
+
+    def store_file(self, path):
+        """
+        Copies (or links, see media_files.store_file) path into the document storage, returning the stored name.
+        Copies are made a chunk at a time, so however large the document is, only one chunk is ever held in memory.
+        """
+        storage = self.DocumentModel._meta.get_field('file').storage
+        return store_file(storage, self.file_name(path), path, self.storage_strategy)
 
     def add_file(self, path):
-        basename = os.path.basename(path)
-
-        image = self.ImageModel(uploaded_by_user=self.owner)
-
-        try:
-            with open(path, 'rb') as image_file:
-                image.file.save(basename, File(image_file), save=True)
-
-            image.title = basename
-            image.save()
-            return image
-        except TypeError:
-            logger.fatal("Not an image? %s", path)
-            return None
+        if self.manifest:
+            self.source_hash(path)
+
+        document = self.DocumentModel(title=os.path.basename(path),
+                                      file=self.store_file(path),
+                                      uploaded_by_user=self.owner)
+        self.library_index[document.file.name] = document
+        self.new_documents.append((path, document))
+        if len(self.new_documents) >= self.batch_size:
+            self.insert_documents()
+        return document
 
     def update_file(self, path):
-        basename = os.path.basename(path)
-        image = self.get_image_record(path)
-        os.remove(image.file.path)
-        with open(path, 'rb') as image_file:
-            image.file.save(basename, File(image_file), save=True)
-        image.save()
-        return image
+        document = self.get_document_record(path)
+        document.file.storage.delete(document.file.name)
+        document.file = self.store_file(path)
+        self.changed_documents.append(document)
+        if len(self.changed_documents) >= self.batch_size:
+            self.write_changed_documents()
+        return document
+
+    def insert_documents(self):
+        if not self.new_documents:
+            return
+
+        self.DocumentModel.objects.bulk_create([document for _, document in self.new_documents])
+
+        new_documents = self.new_documents
+        if any(document.pk is None for _, document in new_documents):
+            # bulk_create only tells some databases' objects their ids, which search indexing needs
+            saved = dict((document.file.name, document) for document in self.DocumentModel.objects.filter(
+                file__in=[document.file.name for _, document in new_documents]))
+            new_documents = [(path, saved.get(document.file.name, document)) for path, document in new_documents]
+
+        for path, document in new_documents:
+            self.library_index[document.file.name] = document
+            self.record(path, document)
+
+        index_objects(self.DocumentModel, [document for _, document in new_documents if document.pk is not None])
+        self.new_documents = []
+
+    def write_changed_documents(self):
+        # the stored name only changes if the storage had to pick another one
+        for document in self.changed_documents:
+            self.DocumentModel.objects.filter(pk=document.pk).update(file=document.file.name)
+        self.changed_documents = []
+
+    def load_library_index(self):
+        """
+        Reads every document in the library with a single query; see ImageImporter.load_library_index.
+        """
+        self.library_index = dict((document.file.name, document) for document in self.DocumentModel.objects.all())
 
     def is_duplicate_name(self, path):
-        file_name = get_upload_to(self.image_instance, os.path.basename(path))
-        image_query = self.ImageModel.objects.filter(file=file_name)
-        return image_query.exists()
+        return self.file_name(path) in self.library_index
 
-    def get_image_record(self, path):
-        file_name = get_upload_to(self.image_instance, os.path.basename(path))
-        image = self.ImageModel.objects.get(file=file_name)
-        return image
+    def get_document_record(self, path):
+        return self.library_index[self.file_name(path)]
 
-    def is_duplicate_image(self, path):
-        image = self.get_image_record(path)
-        return filecmp.cmp(image.file.path, path)
+    def is_duplicate_document(self, path):
+        return self.is_same_file(path, self.get_document_record(path).file.path)
 
-    def add_images_to_library(self, path):
+    def add_documents_to_library(self, path):
 
         for path in [os.path.join(path, p) for p in os.listdir(path)]:
             if os.path.isdir(path):
-                self.add_images_to_library(path)
+                self.add_documents_to_library(path)
             elif os.path.isfile(path):
                 self.increment_stat('total')
-                if self.is_duplicate_name(path):
-                    if self.is_duplicate_image(path):
-                        #self.stdout.write("Unchanged: {0} (skipped)".format(path))
+                if self.is_unchanged(path):
+                    self.increment_stat('unchanged')
+                elif self.is_duplicate_name(path):
+                    if self.is_duplicate_document(path):
+                        self.record(path, self.get_document_record(path))
                         self.increment_stat('unchanged')
                     else:
-                        image = self.update_file(path)
-                        self.stdout.write("Updated: {0} (updating image, retaining id {1})".format(path, image.id))
+                        document = self.update_file(path)
+                        self.record(path, document)
+                        self.stdout.write("Updated: {0} (updating document, retaining id {1})".format(path,
+                                                                                                 document.id))
                         self.increment_stat('altered')
                 else:
-                    self.stdout.write("Adding new image {0}".format(path))
-                    if self.add_file(path):
-                        self.increment_stat('inserted')
-                    else:
-                        self.increment_stat('ignored')
+                    self.stdout.write("Adding new document {0}".format(path))
+                    self.add_file(path)
+                    self.increment_stat('inserted')
 
     def get_results(self):
         return self.results
 
 
-
 class Command(BaseCommand):
     args = '<content directory>'
     help = 'Imports files found in <content directory>/document-library into the Wagtail Document Library'
@@ -121,6 +168,18 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--content', dest='content_path', type='string', ),
         make_option('--owner', dest='owner', type='string'),
+        make_option('--manifest', dest='manifest_path', type='string',
+                    help='Where to keep the size, mtime and hash of each imported file, '
+                         'defaults to <content dir>/.bootstrap_documents.json'),
+        make_option('--batch-size', dest='batch_size', type='int', default=100),
+        make_option('--storage-strategy', dest='storage_strategy', type='choice', choices=STORAGE_STRATEGIES,
+                    default='storage',
+                    help='How to put document files into MEDIA_ROOT: storage (the default, through Django\'s '
+                         'storage), hardlink, reflink or copy. hardlink and reflink fall back to copy when '
+                         'they aren\'t possible.'),
+        make_option('--commit', dest='commit', type='string', default='all',
+                    help='all (the default) to import everything in one transaction, or a number N to commit '
+                         'every N documents. Files are copied to storage either way.'),
     )
 
     def handle(self, *args, **options):
@@ -144,18 +203,25 @@ class Command(BaseCommand):
         if not os.path.isdir(path):
             raise CommandError("Content dir '{0}' does not exist or is not a directory".format(path))
 
-        content_path = os.path.join(path, 'image-library')
+        content_path = os.path.join(path, 'document-library')
         if not os.path.isdir(content_path):
-            raise CommandError("Could not find image library '{0}'".format(content_path))
+            raise CommandError("Could not find document library '{0}'".format(content_path))
+
+        try:
+            commits = CommitStrategy(options['commit'])
+        except BootstrapError as ex:
+            raise CommandError(str(ex))
+
+        manifest = Manifest.load(options['manifest_path'] or os.path.join(path, '.bootstrap_documents.json'))
 
-        importer = DocumentImporter(path=content_path, owner=owner, stdout=self.stdout, stderr=self.stderr)
-        importer.import_documents()
+        importer = DocumentImporter(path=content_path, owner=owner, stdout=self.stdout, stderr=self.stderr,
+                                    commits=commits, manifest=manifest, batch_size=options['batch_size'],
+                                    storage_strategy=options['storage_strategy'])
+        with commits.run():
+            importer.import_documents()
         results = importer.get_results()
         print("Total: {0}, unchanged: {1}, replaced: {2}, new: {3}, ignored: {4}".format(results['total'],
                                                                                          results['unchanged'],
                                                                                          results['altered'],
                                                                                          results['inserted'],
                                                                                          results['ignored']))
-
-
-
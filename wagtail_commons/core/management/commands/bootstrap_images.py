@@ -1,6 +1,6 @@
 import logging
 from django.conf import settings
-from django.core.files import File
+from django.core.files.images import get_image_dimensions
 from wagtail.wagtailimages.models import get_image_model
 
 try:
@@ -11,30 +11,42 @@ except ImportError:
 
 __author__ = 'brett@codigious.com'
 
-import filecmp
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from optparse import make_option
 from django.contrib.auth.models import User
 
 from django.core.management.base import BaseCommand, CommandError
 
+from .utils import CommitStrategy, BootstrapError, index_objects
+from .manifest import Manifest, LibraryManifestMixin
+from .media_files import STORAGE_STRATEGIES, store_file
+from .renditions import find_filter_specs, pregenerate_renditions, template_dirs
+
 # <embed alt="urn" embedtype="image" format="right" id="1"/>
 
 logger = logging.getLogger(__name__)
 
-class ImageImporter(object):
+class ImageImporter(LibraryManifestMixin):
 
     ImageModel = get_image_model()
     image_instance = ImageModel()
 
-    def __init__(self, path, owner, stdout, stderr):
+    def __init__(self, path, owner, stdout, stderr, commits=None, manifest=None, storage_strategy='storage'):
         # TODO remove dependency on stdout/stderr (this is invoked by other management scripts...)
 
         self.library_path = path
         self.owner = owner
         self.stdout = stdout
         self.stderr = stderr
+        self.commits = commits
+        self.manifest = manifest
+        self.storage_strategy = storage_strategy
+        self.source_hashes = {}
+        self.library_index = {}
+        self.changed_images = []
+        self.batch_size = 100
         self.results = {'total': 0,
                         'unchanged': 0,
                         'altered': 0,
@@ -43,48 +55,86 @@ class ImageImporter(object):
 
     def increment_stat(self, stat):
         self.results[stat] += 1
-
-    def import_images(self):
-        self.add_images_to_library(self.library_path)
+        if self.commits and stat in ('altered', 'inserted'):
+            self.commits.tick()
+
+    def import_images(self, jobs=1, batch_size=100):
+        self.batch_size = batch_size
+        self.load_library_index()
+        if jobs and jobs > 1:
+            self.add_images_concurrently(self.library_path, jobs, batch_size)
+        else:
+            self.add_images_to_library(self.library_path)
+        self.write_changed_images()
+        if self.manifest:
+            self.manifest.save()
 
     def add_file(self, path):
         basename = os.path.basename(path)
 
-        image = self.ImageModel(uploaded_by_user=self.owner)
-
-        try:
-            with open(path, 'rb') as image_file:
-                image.file.save(basename, File(image_file), save=True)
-
-            image.title = basename
-            image.save()
-            return image
-        except TypeError:
+        with open(path, 'rb') as image_file:
+            width, height = get_image_dimensions(image_file)
+        if width is None:
             logger.fatal("Not an image? %s", path)
             return None
 
+        image = self.ImageModel(uploaded_by_user=self.owner,
+                                title=basename,
+                                file=self.store_file(path),
+                                width=width,
+                                height=height)
+        image.save()
+        self.library_index[image.file.name] = image
+        return image
+
     def update_file(self, path):
-        basename = os.path.basename(path)
+        with open(path, 'rb') as image_file:
+            width, _ = get_image_dimensions(image_file)
+        if width is None:
+            logger.fatal("Not an image? %s", path)
+            return None  # the existing image is left as it is
+
         image = self.get_image_record(path)
         os.remove(image.file.path)
-        with open(path, 'rb') as image_file:
-            image.file.save(basename, File(image_file), save=True)
-        image.save()
+        image.file = self.store_file(path)  # the descriptor re-reads width and height
+        self.add_changed_image(image)
         return image
 
+    def file_name(self, path):
+        return get_upload_to(self.image_instance, os.path.basename(path))
+
+    def load_library_index(self):
+        """
+        Reads every image in the library with a single query, so that deciding whether a file is new, unchanged
+        or replaces an existing image doesn't need any queries. The stored sizes and hashes of those images
+        come from the manifest (see stored_hash).
+        """
+        self.library_index = dict((image.file.name, image) for image in self.ImageModel.objects.all())
+
     def is_duplicate_name(self, path):
-        file_name = get_upload_to(self.image_instance, os.path.basename(path))
-        image_query = self.ImageModel.objects.filter(file=file_name)
-        return image_query.exists()
+        return self.file_name(path) in self.library_index
 
     def get_image_record(self, path):
-        file_name = get_upload_to(self.image_instance, os.path.basename(path))
-        image = self.ImageModel.objects.get(file=file_name)
-        return image
+        return self.library_index[self.file_name(path)]
+
+    def add_changed_image(self, image):
+        self.changed_images.append(image)
+        if len(self.changed_images) >= self.batch_size:
+            self.write_changed_images()
+
+    def write_changed_images(self):
+        """
+        Writes the new file, width and height of replaced images, with an UPDATE of just those columns for each,
+        rather than a full save(). Django has no multi-row update of differing values.
+        """
+        for image in self.changed_images:
+            self.ImageModel.objects.filter(pk=image.pk).update(file=image.file.name,
+                                                               width=image.width,
+                                                               height=image.height)
+        self.changed_images = []
 
     def is_duplicate_image(self, path):
-        image = self.get_image_record(path)
-        return filecmp.cmp(image.file.path, path)
+        return self.is_same_file(path, self.get_image_record(path).file.path)
 
     def add_images_to_library(self, path):
 
@@ -92,21 +142,150 @@ class ImageImporter(object):
             if os.path.isdir(path):
                 self.add_images_to_library(path)
             elif os.path.isfile(path):
-                self.increment_stat('total')
-                if self.is_duplicate_name(path):
-                    if self.is_duplicate_image(path):
-                        #self.stdout.write("Unchanged: {0} (skipped)".format(path))
-                        self.increment_stat('unchanged')
-                    else:
-                        image = self.update_file(path)
-                        self.stdout.write("Updated: {0} (updating image, retaining id {1})".format(path, image.id))
-                        self.increment_stat('altered')
+                self.add_image(path)
+
+    def add_image(self, path):
+        self.increment_stat('total')
+        if self.is_unchanged(path):
+            self.increment_stat('unchanged')
+        elif self.is_duplicate_name(path):
+            if self.is_duplicate_image(path):
+                #self.stdout.write("Unchanged: {0} (skipped)".format(path))
+                self.record(path, self.get_image_record(path))
+                self.increment_stat('unchanged')
+            else:
+                image = self.update_file(path)
+                if image:
+                    self.record(path, image)
+                    self.stdout.write("Updated: {0} (updating image, retaining id {1})".format(path, image.id))
+                    self.increment_stat('altered')
                 else:
-                    self.stdout.write("Adding new image {0}".format(path))
-                    if self.add_file(path):
-                        self.increment_stat('inserted')
-                    else:
-                        self.increment_stat('ignored')
+                    self.increment_stat('ignored')
+        else:
+            self.stdout.write("Adding new image {0}".format(path))
+            image = self.add_file(path)
+            if image:
+                self.record(path, image)
+                self.increment_stat('inserted')
+            else:
+                self.increment_stat('ignored')
+
+    def find_files(self, path):
+        files = []
+        for path in [os.path.join(path, p) for p in os.listdir(path)]:
+            if os.path.isdir(path):
+                files.extend(self.find_files(path))
+            elif os.path.isfile(path):
+                files.append(path)
+        return files
+
+    def store_file(self, path):
+        storage = self.ImageModel._meta.get_field('file').storage
+        return store_file(storage, self.file_name(path), path, self.storage_strategy)
+
+    def ingest_file(self, path, image):
+        """
+        Hashes, measures and copies one file into storage, for add_images_concurrently. This runs on a worker
+        thread, so it must not touch the database. Returns the stat it should be counted as, and for new or
+        changed images, (stored file name, width, height).
+        """
+        if image is not None and self.is_same_file(path, image.file.path):
+            return 'unchanged', None
+
+        with open(path, 'rb') as image_file:
+            width, height = get_image_dimensions(image_file)
+        if width is None:
+            return 'ignored', None
+
+        if image is not None:
+            os.remove(image.file.path)
+
+        if self.manifest:
+            self.source_hash(path)  # so that record() doesn't hash the file on the writing thread
+
+        stored = (self.store_file(path), width, height)
+        return ('altered' if image is not None else 'inserted'), stored
+
+    def add_images_concurrently(self, path, jobs, batch_size):
+        """
+        Like add_images_to_library, but the files are hashed, measured and copied into storage by a pool of jobs
+        threads, while this thread makes all of the database changes, inserting new images batch_size at a time.
+
+        A file with the same name as one before it (in another directory) is compared with, and may replace, the
+        image that file became, just like add_images_to_library would; those files are imported one by one,
+        once the pool is done.
+        """
+        pending = []
+        same_names = []
+        queued_names = set()
+        for file_path in self.find_files(path):
+            file_name = self.file_name(file_path)
+            if file_name in queued_names:
+                same_names.append(file_path)
+                continue
+            queued_names.add(file_name)
+
+            self.increment_stat('total')
+            if self.is_unchanged(file_path):
+                self.increment_stat('unchanged')
+            elif self.is_duplicate_name(file_path):
+                pending.append((file_path, self.get_image_record(file_path)))
+            else:
+                pending.append((file_path, None))
+
+        def ingest(item):
+            return self.ingest_file(*item)
+
+        new_images = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for (file_path, image), (stat, stored) in zip(pending, executor.map(ingest, pending)):
+                if stat == 'unchanged':
+                    self.record(file_path, image)
+                elif stat == 'ignored':
+                    logger.fatal("Not an image? %s", file_path)
+                elif stat == 'altered':
+                    image.file, image.width, image.height = stored
+                    self.add_changed_image(image)
+                    self.record(file_path, image)
+                    self.stdout.write("Updated: {0} (updating image, retaining id {1})".format(file_path, image.id))
+                else:
+                    self.stdout.write("Adding new image {0}".format(file_path))
+                    file_name, width, height = stored
+                    new_images.append((file_path, self.ImageModel(title=os.path.basename(file_path),
+                                                                  file=file_name,
+                                                                  width=width,
+                                                                  height=height,
+                                                                  uploaded_by_user=self.owner)))
+                    if len(new_images) >= batch_size:
+                        self.insert_images(new_images)
+                        new_images = []
+
+                self.increment_stat(stat)
+
+        self.insert_images(new_images)
+
+        if same_names:
+            self.write_changed_images()
+            for file_path in same_names:
+                self.add_image(file_path)
+
+    def insert_images(self, new_images):
+        if not new_images:
+            return
+
+        self.ImageModel.objects.bulk_create([image for _, image in new_images])
+
+        if any(image.pk is None for _, image in new_images):
+            # bulk_create only tells some databases' objects their ids, which search indexing needs
+            saved = dict((image.file.name, image) for image in
+                         self.ImageModel.objects.filter(file__in=[image.file.name for _, image in new_images]))
+            new_images = [(file_path, saved.get(image.file.name, image)) for file_path, image in new_images]
+
+        for file_path, image in new_images:
+            self.library_index[image.file.name] = image
+            self.record(file_path, image)
+
+        index_objects(self.ImageModel, [image for _, image in new_images if image.pk is not None])
 
     def get_results(self):
         return self.results
@@ -120,6 +299,25 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--content', dest='content_path', type='string', ),
         make_option('--owner', dest='owner', type='string'),
+        make_option('--manifest', dest='manifest_path', type='string',
+                    help='Where to keep the size, mtime and hash of each imported file, '
+                         'defaults to <content dir>/.bootstrap_images.json'),
+        make_option('--jobs', dest='jobs', type='int', default=1,
+                    help='Number of threads hashing and copying image files'),
+        make_option('--batch-size', dest='batch_size', type='int', default=100),
+        make_option('--storage-strategy', dest='storage_strategy', type='choice', choices=STORAGE_STRATEGIES,
+                    default='storage',
+                    help='How to put image files into MEDIA_ROOT: storage (the default, through Django\'s '
+                         'storage), hardlink, reflink or copy. hardlink and reflink fall back to copy when '
+                         'they aren\'t possible.'),
+        make_option('--renditions', dest='renditions', action='store_true', default=False,
+                    help='After importing, generate the renditions used by image tags in templates and content, '
+                         'using --jobs processes. A filter spec used by wagtailimages\' {% image %} tag is generated '
+                         'for every image in the library; one only used by our own {% image "file" "format" %} tag '
+                         'only for the images it names.'),
+        make_option('--commit', dest='commit', type='string', default='all',
+                    help='all (the default) to import everything in one transaction, or a number N to commit '
+                         'every N images. Image files are copied to storage either way.'),
     )
 
     def handle(self, *args, **options):
@@ -147,8 +345,18 @@ class Command(BaseCommand):
         if not os.path.isdir(content_path):
             raise CommandError("Could not find image library '{0}'".format(content_path))
 
-        importer = ImageImporter(path=content_path, owner=owner, stdout=self.stdout, stderr=self.stderr)
-        importer.import_images()
+        try:
+            commits = CommitStrategy(options['commit'])
+        except BootstrapError as ex:
+            raise CommandError(str(ex))
+
+        manifest = Manifest.load(options['manifest_path'] or os.path.join(path, '.bootstrap_images.json'))
+
+        importer = ImageImporter(path=content_path, owner=owner, stdout=self.stdout, stderr=self.stderr,
+                                 commits=commits, manifest=manifest,
+                                 storage_strategy=options['storage_strategy'])
+        with commits.run():
+            importer.import_images(jobs=options['jobs'], batch_size=options['batch_size'])
         results = importer.get_results()
         print("Total: {0}, unchanged: {1}, replaced: {2}, new: {3}, ignored: {4}".format(results['total'],
                                                                                          results['unchanged'],
@@ -156,5 +364,14 @@ class Command(BaseCommand):
                                                                                          results['inserted'],
                                                                                          results['ignored']))
 
+        if options['renditions']:
+            filter_specs = find_filter_specs(os.path.join(path, 'pages'), *template_dirs())
+            self.stdout.write("Generating renditions for filter specs: {0}".format(', '.join(sorted(filter_specs))))
+            generated, skipped, failed, seconds = pregenerate_renditions(filter_specs, jobs=options['jobs'],
+                                                                         stdout=self.stdout)
+            self.stdout.write("Renditions generated: {0}, already existing: {1}, failed: {2}, "
+                              "in {3:.1f}s ({4:.1f}/s)".format(generated, skipped, failed, seconds,
+                                                               generated / seconds if seconds else 0))
+
 
 
@@ -5,20 +5,21 @@ import codecs
 import os
 from io import StringIO
 from optparse import make_option
-from collections import ChainMap
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import yaml, yaml.parser
 import markdown
 
 from django.db.models.fields.related import RelatedField
+from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
-from django.db import models
+from django.db import models, connections
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.template import Template, Context, add_to_builtins
 #from django.template import add_to_builtins
 from django.conf import settings
-from django.db.models.loading import get_model
 
 from wagtail.wagtailcore.models import Site
 from wagtail.wagtailcore.models import Page
@@ -42,10 +43,11 @@ class ModelBuilder(object):
 
     def __init__(self, content_type, model_attrs, model_meta_attrs):
         app_label, model_name = content_type.split('.')
+        self.content_type = content_type
         self.app_label = app_label
         self.model_name = model_name
         self.model_meta_attrs =model_meta_attrs
-        self.model_class = get_model(app_label, model_name)
+        self.model_class = utils.model_for_type(content_type)
         self.model_attrs = model_attrs
         self.instance = None
 
@@ -55,6 +57,45 @@ class ModelBuilder(object):
             self.natural_key = None
 
 
+    def __str__(self):
+        return self.content_type
+
+    def field_names(self):
+        names = OrderedDict()
+        for attrs in self.model_attrs:
+            names.update((name, None) for name in attrs)
+        return list(names)
+
+    def referenced_models(self):
+        """
+        Returns the models that objects created from this file refer to: the targets of the foreign keys (and many
+        to many fields) given a value, those of the related objects' foreign keys (other than the one back to this
+        model, which $self fills in), and Page, if $path is used.
+        """
+        referenced = set()
+        for field_name in self.field_names():
+            (field_object, model, direct, m2m) = self.model_class._meta.get_field_by_name(field_name)
+
+            if direct:
+                if isinstance(field_object, (models.ForeignKey, models.ManyToManyField)):
+                    referenced.add(field_object.rel.to)
+            else:
+                for field in field_object.model._meta.concrete_fields:
+                    if isinstance(field, models.ForeignKey) and not issubclass(self.model_class, field.rel.to):
+                        referenced.add(field.rel.to)
+
+        if uses_path(self.model_meta_attrs):
+            referenced.add(Page)
+
+        referenced.discard(self.model_class)
+        return referenced
+
+    def build(self, commits=None, bulk=False, batch_size=500):
+        if bulk:
+            self.instantiate_bulk(commits, batch_size=batch_size)
+        else:
+            self.instantiate(commits)
+
     def get_instance_for_natural_key(self, attrs):
         if self.natural_key:
             try:
@@ -64,11 +105,13 @@ class ModelBuilder(object):
 
         return self.model_class()
 
-    def instantiate(self):
+    def instantiate(self, commits=None):
         logger.info("Creating %s", self.model_class)
 
         for attrs in self.model_attrs:
             self.instantiate_object(attrs)
+            if commits:
+                commits.tick()
 
     def interpolate(self, field_name, attrs):
 
@@ -107,26 +150,46 @@ class ModelBuilder(object):
         return new_objects
 
 
-    def instantiate_object(self, attrs):
-        instance = self.get_instance_for_natural_key(attrs)
-        self.instance = instance
-
-        deferred_objects = []
-
+    def set_direct_attributes(self, instance, attrs, foreign_keys=None):
+        """
+        Assigns the values in attrs which belong to the model's own fields (rather than to related objects),
+        returning the names of the concrete fields whose value changed. foreign_keys, if given, is a dict in which
+        the objects that foreign key values resolve to are remembered, so each distinct value is looked up once.
+        """
+        changed = []
         for field_name, field_value in attrs.items():
             (field_object, model, direct, m2m) = instance._meta.get_field_by_name(field_name)
 
-            if direct:
-                if isinstance(field_object, models.ForeignKey):
+            if not direct:
+                continue
+
+            if isinstance(field_object, models.ForeignKey):
+                if foreign_keys is None:
                     f = utils.transformation_for_foreign_key(field_object)
                     related_value = f(field_value)
-                    setattr(instance, field_name, related_value)
-                    #raise Exception("Foreign Keys on models are unsupported, field {} = {}, type: {}".format(field_name, field_value, field_object))
                 else:
-                    setattr(instance, field_name, field_value)
-
-        self.instance.save()
-
+                    key = (field_name, field_value)
+                    if key not in foreign_keys:
+                        f = utils.transformation_for_foreign_key(field_object)
+                        foreign_keys[key] = f(field_value)
+                    related_value = foreign_keys[key]
+
+                related_id = related_value.pk if related_value is not None else None
+                if getattr(instance, field_object.attname) != related_id:
+                    changed.append(field_name)
+                setattr(instance, field_name, related_value)
+            else:
+                if not m2m and getattr(instance, field_object.attname) != field_value:
+                    changed.append(field_name)
+                setattr(instance, field_name, field_value)
+
+        return changed
+
+    def build_related_objects(self, instance, attrs):
+        """
+        Returns a (related model, unsaved objects) pair for each relation of instance which attrs gives objects for.
+        """
+        related = []
         for field_name, field_value in attrs.items():
             (field_object, model, direct, m2m) = instance._meta.get_field_by_name(field_name)
 
@@ -134,12 +197,130 @@ class ModelBuilder(object):
                 related_model = field_object.model
                 model_meta_attrs = self.model_meta_attrs.get(field_name, {})
                 related_objects = self.instantiate_related_objects(related_model, field_value, model_meta_attrs)
-                #setattr(instance, field_name, related_objects)
-                deferred_objects.append((field_name, related_objects))
+                related.append((related_model, related_objects))
 
-        for field_name, related_objects in deferred_objects:
-           for related_object in related_objects:
-               related_object.save()
+        return related
+
+    def instantiate_object(self, attrs):
+        instance = self.get_instance_for_natural_key(attrs)
+        self.instance = instance
+
+        self.set_direct_attributes(instance, attrs)
+        self.instance.save()
+
+        for related_model, related_objects in self.build_related_objects(instance, attrs):
+            for related_object in related_objects:
+                related_object.save()
+
+    def instantiate_bulk(self, commits=None, batch_size=500):
+        """
+        Like instantiate, but with a handful of queries for the whole file rather than several for each object.
+        Existing objects are read with one query (the model's natural_key names the field that identifies them),
+        new objects are inserted with bulk_create, changed objects only have their changed fields updated, and the
+        related objects of every object are inserted with one bulk_create per related model.
+        """
+        logger.info("Creating %s in bulk", self.model_class)
+
+        existing = self.get_existing_instances()
+        foreign_keys = {}
+        new_instances = []
+        changed_instances = OrderedDict()
+        related_objects = OrderedDict()
+
+        for attrs in self.model_attrs:
+            key = self.natural_key_value(attrs.get(self.natural_key)) if self.natural_key else None
+            instance = existing.get(key) if key is not None else None
+            if instance is None:
+                instance = self.model_class()
+                new_instances.append(instance)
+                if key is not None:
+                    existing[key] = instance
+            self.instance = instance
+
+            changed = self.set_direct_attributes(instance, attrs, foreign_keys)
+            if instance.pk is not None and changed:
+                changed_instances.setdefault(instance.pk, (instance, set()))[1].update(changed)
+
+            for related_model, objects in self.build_related_objects(instance, attrs):
+                related_objects.setdefault(related_model, []).extend(objects)
+
+        self.insert_instances(new_instances, batch_size, needs_ids=bool(related_objects))
+        self.update_instances(changed_instances.values(), batch_size)
+        self.insert_related_objects(related_objects, batch_size)
+
+        logger.info("%s: %d new, %d changed, %d unchanged", self.model_class.__name__, len(new_instances),
+                    len(changed_instances), len(self.model_attrs) - len(new_instances) - len(changed_instances))
+        if commits:
+            commits.tick(len(self.model_attrs))
+
+    def natural_key_value(self, val):
+        """
+        Returns val as the natural key field's Python value, so that the keys read from YAML compare equal to the
+        ones read from the database (an int key in YAML, say, against a CharField), just as get_by_natural_key
+        lets the database coerce them.
+        """
+        if val is None:
+            return None
+        try:
+            return self.model_class._meta.get_field(self.natural_key).to_python(val)
+        except (models.FieldDoesNotExist, ValidationError):
+            return str(val)
+
+    def get_existing_instances(self):
+        if not self.natural_key:
+            return {}
+        return dict((self.natural_key_value(getattr(instance, self.natural_key)), instance)
+                    for instance in self.model_class.objects.all().iterator())
+
+    def insert_instances(self, instances, batch_size, needs_ids=False):
+        if not instances:
+            return
+
+        # bulk_create can't write multi-table models, and only some databases tell it the ids of the new rows
+        if self.model_class._meta.parents or (needs_ids and not self.natural_key):
+            for instance in instances:
+                instance.save()
+            return
+
+        self.model_class.objects.bulk_create(instances, batch_size=batch_size)
+
+        if needs_ids and any(instance.pk is None for instance in instances):
+            instances_by_key = dict((self.natural_key_value(getattr(instance, self.natural_key)), instance)
+                                    for instance in instances)
+            keys = list(instances_by_key)
+            for i in range(0, len(keys), batch_size):
+                query = self.model_class.objects.filter(**{self.natural_key + '__in': keys[i:i + batch_size]})
+                for key, pk in query.values_list(self.natural_key, 'pk'):
+                    instances_by_key[self.natural_key_value(key)].pk = pk
+
+    def update_instances(self, changed_instances, batch_size):
+        manager = self.model_class.objects
+        if hasattr(manager, 'bulk_update'):
+            by_fields = OrderedDict()
+            for instance, fields in changed_instances:
+                by_fields.setdefault(tuple(sorted(fields)), []).append(instance)
+            for fields, instances in by_fields.items():
+                manager.bulk_update(instances, fields, batch_size=batch_size)
+        else:
+            for instance, fields in changed_instances:
+                instance.save(update_fields=fields)
+
+    def insert_related_objects(self, related_objects, batch_size):
+        for related_model, objects in related_objects.items():
+            # the objects were given their parent before it had an id
+            foreign_keys = [field for field in related_model._meta.concrete_fields
+                            if isinstance(field, models.ForeignKey)]
+            for obj in objects:
+                for field in foreign_keys:
+                    target = getattr(obj, field.get_cache_name(), None)
+                    if target is not None:
+                        setattr(obj, field.attname, target.pk)
+
+            if related_model._meta.parents:
+                for obj in objects:
+                    obj.save()
+            else:
+                related_model.objects.bulk_create(objects, batch_size=batch_size)
 
 
 def load_attributes_from_file(path):
@@ -168,7 +349,7 @@ def load_content(content_directory_path):
     contents = []
 
     for path in contents_paths:
-        content_type = os.path.basename(path)[:-4]
+        content_type = p.match(os.path.basename(path)[:-4]).group(1)
 
         content_attributes, meta_attrs = load_attributes_from_file(path)
         contents.append(ModelBuilder(content_type, model_attrs=content_attributes, model_meta_attrs=meta_attrs))
@@ -177,12 +358,113 @@ def load_content(content_directory_path):
     return contents
 
 
+def uses_path(meta_attrs):
+    if isinstance(meta_attrs, dict):
+        return any(uses_path(value) for value in meta_attrs.values())
+    return meta_attrs == '$path'
+
+
+def dependency_graph(builders):
+    """
+    Returns an OrderedDict of each builder (in file order) to the set of builders which must be run before it:
+    those creating a model that its objects refer to (see ModelBuilder.referenced_models), and earlier files for
+    the same model.
+    """
+    dependencies = OrderedDict()
+    for i, builder in enumerate(builders):
+        referenced = builder.referenced_models()
+        dependencies[builder] = set()
+        for j, other in enumerate(builders):
+            if j == i:
+                continue
+            if (other.model_class is builder.model_class and j < i) or \
+                    any(issubclass(other.model_class, model) for model in referenced):
+                dependencies[builder].add(other)
+    return dependencies
+
+
+def dependency_order(dependencies):
+    """
+    Returns the builders in dependencies in an order that runs every builder after those it depends on, keeping to
+    file order where the dependencies allow. Circular dependencies are broken, in dependencies too, by running the
+    first remaining file anyway.
+    """
+    order = []
+    done = set()
+    remaining = list(dependencies)
+    while remaining:
+        builder = next((b for b in remaining if dependencies[b] <= done), None)
+        if builder is None:
+            builder = remaining[0]
+            logger.warning("Circular dependencies between %s, creating %s first",
+                           ', '.join(str(b) for b in remaining), builder)
+            dependencies[builder] &= done
+
+        remaining.remove(builder)
+        done.add(builder)
+        order.append(builder)
+    return order
+
+
+def build_concurrently(order, dependencies, jobs, commit, bulk=False, batch_size=500):
+    """
+    Runs the builders on a pool of jobs threads, each starting as soon as the builders it depends on have
+    finished. Every thread has its own database connection, so each file is created in a transaction of its
+    own (or committed every N objects, for commit=N), which is committed before anything depending on it starts.
+    After a failure no more files are started; the exception is raised once the running ones have finished.
+    """
+
+    def build(builder):
+        try:
+            commits = utils.CommitStrategy(commit)
+            with commits.run():
+                builder.build(commits, bulk=bulk, batch_size=batch_size)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    done = set()
+    pending = list(order)
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if failure is None:
+                for builder in [b for b in pending if dependencies[b] <= done]:
+                    pending.remove(builder)
+                    running[executor.submit(build, builder)] = builder
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                builder = running.pop(future)
+                if future.exception() is not None:
+                    logger.error("Could not create %s: %s", builder, future.exception())
+                    failure = failure or future.exception()
+                else:
+                    done.add(builder)
+
+    if failure is not None:
+        raise failure
+
+
 class Command(BaseCommand):
     args = '<content directory>'
     help = 'Creates models from markdown and yaml files, found in <content directory>/models'
 
     option_list = BaseCommand.option_list + (
         make_option('--content', dest='content_path', type='string', ),
+        make_option('--commit', dest='commit', type='string', default='all',
+                    help='all (the default) to create everything in one transaction, or a number N to commit every '
+                         'N objects'),
+        make_option('--bulk', dest='bulk', action='store_true', default=False,
+                    help='Read existing objects once per file and write objects and related objects in batches'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500),
+        make_option('--jobs', dest='jobs', type='int', default=1,
+                    help='Create up to this many independent model files at once, each in its own transaction'),
     )
 
     def handle(self, *args, **options):
@@ -194,7 +476,21 @@ class Command(BaseCommand):
 
         contents = load_content(os.path.join(content_path, 'models'))
 
-        for builder in contents:
-            builder.instantiate()
+        try:
+            commits = utils.CommitStrategy(options['commit'])
+        except utils.BootstrapError as ex:
+            raise CommandError(str(ex))
+
+        dependencies = dependency_graph(contents)
+        order = dependency_order(dependencies)
+
+        if options['jobs'] > 1:
+            build_concurrently(order, dependencies, options['jobs'], options['commit'],
+                               bulk=options['bulk'], batch_size=options['batch_size'])
+            return
+
+        with commits.run():
+            for builder in order:
+                builder.build(commits, bulk=options['bulk'], batch_size=options['batch_size'])
 
 
@@ -9,9 +9,29 @@ from optparse import make_option
 import yaml
 import yaml.parser
 from django.contrib.auth.models import User
-from django.db.utils import IntegrityError
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand, CommandError
 
+from .utils import CommitStrategy, BootstrapError, worker_pool
+
+
+def hash_passwords(users, jobs=1):
+    """
+    Returns the password hash of each user, in order. A user's password_hash is used as it is; otherwise their
+    password is hashed, by a pool of jobs processes (see worker_pool) when jobs > 1, since hashers are slow by
+    design. Users with neither get an unusable password.
+    """
+    passwords = [user.get('password') for user in users if 'password_hash' not in user]
+
+    if jobs > 1 and len(passwords) > 1:
+        with worker_pool(jobs) as executor:
+            chunk_size = max(1, len(passwords) // (jobs * 4))
+            hashes = iter(list(executor.map(make_password, passwords, chunksize=chunk_size)))
+    else:
+        hashes = iter([make_password(password) for password in passwords])
+
+    return [user['password_hash'] if 'password_hash' in user else next(hashes) for user in users]
+
 
 class Command(BaseCommand):
     args = '<content directory>'
@@ -19,6 +39,12 @@ class Command(BaseCommand):
 
     option_list = BaseCommand.option_list + (
         make_option('--content', dest='content_path', type='string', ),
+        make_option('--commit', dest='commit', type='string', default='all',
+                    help='all (the default) to create every user in one transaction, or a number N to commit '
+                         'every N users'),
+        make_option('--jobs', dest='jobs', type='int', default=1,
+                    help='Number of processes hashing passwords'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500),
     )
 
     def handle(self, *args, **options):
@@ -42,16 +68,34 @@ class Command(BaseCommand):
         users = next(stream)
         f.close()
 
+        try:
+            commits = CommitStrategy(options['commit'])
+        except BootstrapError as ex:
+            raise CommandError(str(ex))
+
+        existing_usernames = set(User.objects.values_list('username', flat=True))
+        new_users = []
         for user in users:
-            try:
-                u = User.objects.create(username=user['username'],
-                                        email=user['email'],
-                                        first_name=user['first_name'],
-                                        last_name=user['last_name'],
-                                        is_superuser=user['is_superuser'],
-                                        is_staff=user['is_staff'])
-                u.set_password(user['password'])
-                u.save()
-                self.stdout.write("Created {0}".format(user['username']))
-            except IntegrityError:
-                self.stderr.write("Could not create {0}, already exists?".format(user['username']))
\ No newline at end of file
+            if user['username'] in existing_usernames:
+                self.stderr.write("Could not create {0}, already exists".format(user['username']))
+                continue
+            existing_usernames.add(user['username'])
+            new_users.append(user)
+
+        passwords = hash_passwords(new_users, options['jobs'])
+
+        batch_size = options['batch_size']
+        with commits.run():
+            for i in range(0, len(new_users), batch_size):
+                batch = new_users[i:i + batch_size]
+                User.objects.bulk_create([User(username=user['username'],
+                                               email=user['email'],
+                                               first_name=user['first_name'],
+                                               last_name=user['last_name'],
+                                               is_superuser=user['is_superuser'],
+                                               is_staff=user['is_staff'],
+                                               password=password)
+                                          for user, password in zip(batch, passwords[i:i + batch_size])])
+                for user in batch:
+                    self.stdout.write("Created {0}".format(user['username']))
+                commits.tick(len(batch))
@@ -1,5 +1,12 @@
+import yaml
+
 __author__ = 'bgrace'
 
+
+class ParseError(Exception):
+    pass
+
+
 class Token(object):
 
     def __init__(self, contents):
@@ -33,20 +40,111 @@ class Tokenizer(object):
     alphanumeric = ? a-aA-Z ?, ? a-aA-Z0-9 ?
     body = {line} | delimiter, newline;
     line = {printable_character} newline;
+
+    The first body is the YAML front matter (an antecedent token); it ends at the next line which YAML would
+    treat as the start or end of a document. Every following body is introduced by a delimiter and a type token
+    carrying the symbol's name. A delimiter line without a symbol inside such a body is just part of the body
+    (it's a horizontal rule, as far as markdown is concerned). Lines between the front matter and the first
+    symbol are ignored.
+
+    Tokens are produced while the input is being read, so the input is only read once, and never further than
+    the caller has asked for.
     """
 
     delimiter = "---"
 
     def __init__(self, readable):
         self.input = readable
+        self.line_number = 0
+
+    def __iter__(self):
+        return self.tokenize_input()
 
-        self.tokens = []
+    def lines(self):
+        for line in self.input:
+            self.line_number += 1
+            yield line.replace('\r\n', '\n')
 
     def tokenize_input(self):
-        for line in self.input.readline():
-            self.tokens.append(self.tokenize_line(line))
+        lines = self.lines()
+
+        first_line = next(lines, '').rstrip('\n\r')
+        if first_line != self.delimiter:
+            raise ParseError("Malformed input in {0}\n: Line {1}\nExpected first line to only contain '{2}'".
+                             format(getattr(self.input, 'name', self.input), first_line, self.delimiter))
+        yield DocumentDelimiterToken(first_line)
+
+        front_matter = []
+        symbol = None
+        for line in lines:
+            if self.is_document_boundary(line):
+                symbol = self.tokenize_line(line)
+                break
+            front_matter.append(line)
+        yield DocumentAntecedentToken(''.join(front_matter))
+
+        # skip anything between the front matter and the first section
+        while symbol is None:
+            line = next(lines, None)
+            if line is None:
+                return
+            symbol = self.tokenize_line(line)
+
+        body = []
+        for line in lines:
+            next_symbol = self.tokenize_line(line)
+            if next_symbol is None:
+                body.append(line)
+                continue
+
+            yield DocumentDelimiterToken(self.delimiter)
+            yield DocumentTypeToken(symbol)
+            yield DocumentBody(''.join(body))
+            symbol = next_symbol
+            body = []
+
+        yield DocumentDelimiterToken(self.delimiter)
+        yield DocumentTypeToken(symbol)
+        yield DocumentBody(''.join(body))
+
+    def is_document_boundary(self, line):
+        return line.rstrip() in (self.delimiter, '...') or line.startswith(self.delimiter + ' ') or \
+            line.startswith(self.delimiter + '\t')
 
     def tokenize_line(self, line):
-        if line.startswith("---"):
-            # TODO I stopped working right here, finishing this block!
-            pass
\ No newline at end of file
+        """
+        Returns the name of the section started by this line, or None if the line doesn't start one.
+        """
+        if line.startswith(self.delimiter):
+            tokens = line.split()
+            if len(tokens) == 2 and tokens[0] == self.delimiter and tokens[1][0] == '@':
+                return tokens[1][1:]
+        return None
+
+
+class HeaderedDocument(object):
+
+    """
+    A file with YAML front matter followed by any number of "--- @name" sections, read in a single pass.
+    front_matter is parsed as soon as the document is created; the sections are produced, as (name, body)
+    pairs, by iterating sections(), which continues reading the input where the front matter left off.
+    """
+
+    def __init__(self, readable):
+        self.tokens = iter(Tokenizer(readable))
+
+        next(self.tokens)  # the opening delimiter
+        front_matter = yaml.load(next(self.tokens).contents, Loader=yaml.Loader)
+        self.front_matter = front_matter if front_matter is not None else {}
+
+    def sections(self):
+        name = None
+        for token in self.tokens:
+            if isinstance(token, DocumentTypeToken):
+                name = token.contents
+            elif isinstance(token, DocumentBody):
+                yield name, token.contents
+
+
+def parse_document(readable):
+    return HeaderedDocument(readable)
@@ -0,0 +1,164 @@
+import filecmp
+import hashlib
+import json
+import logging
+import os
+
+__author__ = 'brett@codigious.com'
+
+logger = logging.getLogger('wagtail_commons.core')
+
+
+def hash_file(path, block_size=65536, algorithm='sha1'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_documents(*docs):
+    digest = hashlib.sha1()
+    for doc in docs:
+        digest.update(json.dumps(doc, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_signature(path):
+    """
+    Returns the (size, mtime) of path, which is enough to tell that a file hasn't changed without reading it.
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class Manifest(object):
+    """
+    A JSON file recording what a previous run of a bootstrap command saw, so that the next run only needs
+    to touch what has changed. Entries are keyed by whatever the command finds convenient (a url path, a
+    file name) and map to a dict of plain values.
+    """
+
+    version = 1
+
+    def __init__(self, path, entries=None, settings_hash=None):
+        self.path = path
+        self.entries = entries if entries is not None else {}
+        self.settings_hash = settings_hash
+
+    @classmethod
+    def load(cls, path):
+        if not path or not os.path.isfile(path):
+            return cls(path)
+
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                doc = json.load(f)
+        except ValueError:
+            logger.warning("Ignoring unreadable manifest %s", path)
+            return cls(path)
+
+        if doc.get('version') != cls.version:
+            logger.warning("Ignoring manifest %s, it was written by a different version", path)
+            return cls(path)
+
+        return cls(path, entries=doc.get('entries', {}), settings_hash=doc.get('settings'))
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'version': self.version,
+                       'settings': self.settings_hash,
+                       'entries': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+class LibraryManifestMixin(object):
+    """
+    The manifest bookkeeping of the image and document importers. Each file in the library directory is recorded
+    with its size, mtime and sha256, along with the path, size and mtime of its stored copy, so that later runs
+    can tell a file is unchanged from its stat alone, or at worst by hashing just the source.
+
+    Expects self.library_path, self.manifest (a Manifest, or None to always compare file contents),
+    self.source_hashes (a dict) and is_duplicate_name(path), which tells whether the library has a record for path.
+    """
+
+    def manifest_key(self, path):
+        return os.path.relpath(path, self.library_path)
+
+    def source_hash(self, path):
+        try:
+            return self.source_hashes[path]
+        except KeyError:
+            pass
+
+        size, mtime = file_signature(path)
+        entry = self.manifest.get(self.manifest_key(path))
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            sha256 = entry['sha256']
+        else:
+            sha256 = hash_file(path, algorithm='sha256')
+        self.source_hashes[path] = sha256
+        return sha256
+
+    def stored_hash(self, path, stored_path):
+        size, mtime = file_signature(stored_path)
+        entry = self.manifest.get(self.manifest_key(path))
+        stored = entry.get('stored') if entry else None
+        if stored and stored['path'] == stored_path and stored['size'] == size and stored['mtime'] == mtime:
+            return stored['sha256']
+        return hash_file(stored_path, algorithm='sha256')
+
+    def is_same_file(self, path, stored_path):
+        if not self.manifest:
+            return filecmp.cmp(stored_path, path)
+        return self.source_hash(path) == self.stored_hash(path, stored_path)
+
+    def is_unchanged(self, path):
+        """
+        True if, according to the manifest, neither this file nor its copy in the library has changed since they
+        were last compared. Only looks at the files' size and mtime, and at the library index: the manifest and
+        the media files outlive a database which is recreated, and then the file has to be imported again.
+        """
+        if not self.manifest or not self.is_duplicate_name(path):
+            return False
+
+        entry = self.manifest.get(self.manifest_key(path))
+        if not entry or not entry.get('stored'):
+            return False
+
+        try:
+            stored_signature = file_signature(entry['stored']['path'])
+        except OSError:
+            return False
+
+        return file_signature(path) == (entry['size'], entry['mtime']) and \
+            stored_signature == (entry['stored']['size'], entry['stored']['mtime'])
+
+    def record(self, path, instance):
+        """
+        Records that the file at path is stored as instance's file.
+        """
+        if not self.manifest or instance is None:
+            return
+
+        # the stored file is either a copy of this one, or was found to have the same hash
+        size, mtime = file_signature(path)
+        sha256 = self.source_hash(path)
+        stored_path = instance.file.path
+        stored_size, stored_mtime = file_signature(stored_path)
+        self.manifest.entries[self.manifest_key(path)] = {
+            'size': size,
+            'mtime': mtime,
+            'sha256': sha256,
+            'stored': {'path': stored_path,
+                       'size': stored_size,
+                       'mtime': stored_mtime,
+                       'sha256': sha256},
+        }
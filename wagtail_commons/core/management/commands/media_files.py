@@ -0,0 +1,98 @@
+import errno
+import logging
+import os
+import shutil
+
+from django.core.files import File
+
+__author__ = 'brett@codigious.com'
+
+logger = logging.getLogger('wagtail_commons.core')
+
+FICLONE = 0x40049409  # linux/fs.h
+
+STORAGE_STRATEGIES = ('storage', 'hardlink', 'reflink', 'copy')
+
+
+def link_file(source_path, destination_path):
+    os.link(source_path, destination_path)
+
+
+def reflink_file(source_path, destination_path):
+    """
+    Makes destination_path a copy-on-write clone of source_path, on filesystems which support it (btrfs, XFS).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform")
+
+    with open(source_path, 'rb') as source:
+        fd = os.open(destination_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            fcntl.ioctl(fd, FICLONE, source.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            os.remove(destination_path)
+            raise
+        os.close(fd)
+
+
+def copy_file(source_path, destination_path):
+    with open(source_path, 'rb') as source, open(destination_path, 'xb') as destination:
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+
+
+# what each strategy tries, in order, until something works
+STRATEGY_METHODS = {
+    'hardlink': (link_file, reflink_file, copy_file),
+    'reflink': (reflink_file, copy_file),
+    'copy': (copy_file, ),
+}
+
+
+def store_file(storage, name, source_path, strategy='storage'):
+    """
+    Puts the file at source_path into storage under name (or, if that's taken, whatever name the storage picks
+    instead) and returns the name it was stored under.
+
+    The 'storage' strategy goes through storage.save, like an upload would. The others only work for storages
+    with local paths (FileSystemStorage, i.e., MEDIA_ROOT): 'hardlink' links the stored file to the source,
+    'reflink' makes a copy-on-write clone of it, and 'copy' copies it without going through Django's File
+    layer. A hardlink or reflink that isn't possible (e.g., the source is on another filesystem) falls back to
+    the next method, and ultimately to a plain copy.
+    """
+    if strategy != 'storage':
+        try:
+            storage.path(name)
+        except NotImplementedError:
+            logger.warning("%s has no local paths, saving %s through it instead", storage.__class__.__name__,
+                           source_path)
+            strategy = 'storage'
+
+    if strategy == 'storage':
+        with open(source_path, 'rb') as source:
+            return storage.save(name, File(source))
+
+    while True:
+        name = storage.get_available_name(name)
+        path = storage.path(name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        for method in STRATEGY_METHODS[strategy]:
+            try:
+                method(source_path, path)
+            except FileExistsError:
+                break  # another thread got this name first, pick another one
+            except (IOError, OSError) as ex:
+                logger.debug("Could not %s %s: %s", method.__name__, source_path, ex)
+                continue
+
+            permissions = getattr(storage, 'file_permissions_mode', None)
+            if permissions is not None and method is not link_file:
+                os.chmod(path, permissions)
+            return name
+        else:
+            raise OSError("Could not store {0} as {1}".format(source_path, path))
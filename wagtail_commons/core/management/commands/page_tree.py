@@ -0,0 +1,289 @@
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from wagtail.wagtailcore.models import Page, PageRevision
+
+from .utils import index_objects
+
+try:
+    from modelcluster.models import get_all_child_relations
+except ImportError:
+    get_all_child_relations = None
+
+__author__ = 'brett@codigious.com'
+
+logger = logging.getLogger('wagtail_commons.core')
+
+
+def concrete_models_for(page_class):
+    """
+    Returns the concrete models whose tables hold a page_class row, from Page down to page_class itself.
+    """
+    parents = [model for model in page_class._meta.get_parent_list() if not model._meta.abstract]
+    parents.sort(key=lambda model: len(model._meta.get_parent_list()))
+    return parents + [page_class]
+
+
+def wipe_page_tree(root):
+    """
+    Deletes every page below root, along with their revisions, leaving root childless.
+
+    Rather than deleting page by page (each delete cascading to the page's descendants, so that most later
+    deletes find their page already gone), this deletes the revisions in one go and then each concrete page
+    model's rows, most derived model first. Django's collector still follows the relations of each model,
+    but does so in batches. treebeard's MP_NodeQuerySet.delete is bypassed, since it would re-read and
+    re-save parents which are about to be deleted anyway.
+    """
+    pages = Page.objects.filter(path__startswith=root.path, depth__gt=root.depth)
+
+    QuerySet.delete(PageRevision.objects.filter(page__in=pages))
+
+    page_models = set()
+    for content_type_id in pages.values_list('content_type', flat=True).distinct():
+        page_models.add(ContentType.objects.get_for_id(content_type_id).model_class() or Page)
+    page_models.add(Page)
+
+    for model in sorted(page_models, key=lambda model: len(model._meta.get_parent_list()), reverse=True):
+        QuerySet.delete(model.objects.filter(path__startswith=root.path, depth__gt=root.depth))
+
+    Page.objects.filter(pk=root.pk).update(numchild=0)
+    root.numchild = 0
+
+
+class BulkPageInserter(object):
+    """
+    Builds up a tree of unsaved pages in memory, working out each page's treebeard path, depth and numchild,
+    and its url_path, as it goes. flush() then writes them with a few multi-row INSERTs per table, rather
+    than the locking, re-reading and saving that add_child() does for every single page.
+
+    Pages must be added parent first, which is the order SiteNode.instantiate_page visits them in. Parents
+    which are already in the database (e.g., the root node) are only read once, to find their last child.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.pages = []
+        self.last_steps = {}
+        self.existing_parents = {}
+
+    def add_child(self, parent_page, page):
+        if parent_page.path not in self.last_steps:
+            last_child = parent_page.get_last_child()
+            self.last_steps[parent_page.path] = Page._str2int(last_child.path[-Page.steplen:]) if last_child else 0
+            self.existing_parents[parent_page.path] = parent_page
+
+        self.last_steps[parent_page.path] += 1
+
+        page.depth = parent_page.depth + 1
+        page.path = Page._get_path(parent_page.path, page.depth, self.last_steps[parent_page.path])
+        page.numchild = 0
+        page.url_path = parent_page.url_path + page.slug + '/'
+        parent_page.numchild += 1
+
+        self.last_steps[page.path] = 0
+        self.pages.append(page)
+
+    def flush(self):
+        if not self.pages:
+            return
+
+        using = router.db_for_write(Page)
+
+        Page.objects.using(using).bulk_create(self.pages, batch_size=self.batch_size)
+        self.assign_ids(using)
+        self.resolve_foreign_keys(using)
+
+        pages_by_model = {}
+        for page in self.pages:
+            for model in concrete_models_for(page.__class__)[1:]:
+                pages_by_model.setdefault(model, []).append(page)
+
+        for model in sorted(pages_by_model, key=lambda model: len(model._meta.get_parent_list())):
+            self.insert_rows(model, pages_by_model[model], using)
+
+        for path, parent_page in self.existing_parents.items():
+            Page.objects.using(using).filter(pk=parent_page.pk).update(numchild=parent_page.numchild)
+
+        pages_by_class = {}
+        for page in self.pages:
+            page._state.adding = False
+            page._state.db = using
+            self.commit_child_relations(page)
+            pages_by_class.setdefault(page.__class__, []).append(page)
+
+        for page_class, pages in pages_by_class.items():
+            index_objects(page_class, pages)
+
+        logger.info("Inserted %d pages", len(self.pages))
+
+    def assign_ids(self, using):
+        ids = {}
+        paths = [page.path for page in self.pages]
+        for i in range(0, len(paths), self.batch_size):
+            ids.update(Page.objects.using(using).filter(path__in=paths[i:i + self.batch_size]).
+                       values_list('path', 'id'))
+
+        for page in self.pages:
+            page.id = ids[page.path]
+            for model in concrete_models_for(page.__class__)[1:]:
+                for parent_link in model._meta.parents.values():
+                    setattr(page, parent_link.attname, page.id)
+
+    def resolve_foreign_keys(self, using):
+        """
+        Points foreign keys at the pages they were assigned, now that those have ids: a page assigned before it
+        was inserted (a $path link to an earlier page of the import) left the key's column None. Columns of the
+        page table itself have already been written, so those are updated; the others go out with their rows.
+        """
+        for page in self.pages:
+            page_updates = {}
+            for field in page._meta.concrete_fields:
+                if field.rel is None or getattr(page, field.attname) is not None:
+                    continue
+                target = getattr(page, field.get_cache_name(), None)
+                if target is None or target.pk is None:
+                    continue
+                setattr(page, field.attname, target.pk)
+                if field.model is Page:
+                    page_updates[field.attname] = target.pk
+
+            if page_updates:
+                Page.objects.using(using).filter(pk=page.pk).update(**page_updates)
+
+    def insert_rows(self, model, pages, using):
+        fields = model._meta.local_concrete_fields
+        ops = connections[using].ops
+        batch_size = max(min(self.batch_size, ops.bulk_batch_size(fields, pages)), 1)
+        for i in range(0, len(pages), batch_size):
+            model._base_manager._insert(pages[i:i + batch_size], fields=fields, using=using)
+
+    def commit_child_relations(self, page):
+        # child relations assigned in memory (see SiteNode.set_page_attributes) are normally written by save()
+        if get_all_child_relations is None:
+            return
+        for relation in get_all_child_relations(page):
+            getattr(page, relation.get_accessor_name()).commit()
+
+
+def write_related_objects(deferred_models, batch_size=500):
+    """
+    Replaces the objects of each (page, relation name, relation field, related objects) in deferred_models,
+    with one DELETE, one batched INSERT and one SELECT per related model, rather than saving every object
+    (and its page) separately. Child relations of a ClusterableModel are then reset to the saved objects, so
+    that they carry ids when the page's revision is serialized.
+
+    Related models with concrete parents can't be bulk created, so those are saved the old way.
+    """
+    relations_by_model = {}
+    for page, relation_name, field_object, related_objects in deferred_models:
+        relations_by_model.setdefault((field_object.model, field_object.field.name), []).append(
+            (page, relation_name, related_objects))
+
+    for (model, fk_name), relations in relations_by_model.items():
+        if model._meta.parents:
+            for page, relation_name, related_objects in relations:
+                setattr(page, relation_name, related_objects)
+                relation = getattr(page, relation_name)
+                if hasattr(relation, 'commit'):
+                    relation.commit()
+            continue
+
+        fk_attname = model._meta.get_field(fk_name).attname
+        field_names = model._meta.get_all_field_names()
+        page_ids = [page.id for page, _, _ in relations]
+
+        new_objects = []
+        for page, relation_name, related_objects in relations:
+            for i, related_object in enumerate(related_objects):
+                setattr(related_object, fk_attname, page.id)
+                if 'sort_order' in field_names and getattr(related_object, 'sort_order', None) is None:
+                    related_object.sort_order = i
+                new_objects.append(related_object)
+
+        for i in range(0, len(page_ids), batch_size):
+            QuerySet.delete(model._default_manager.filter(**{fk_name + '__in': page_ids[i:i + batch_size]}))
+        model._default_manager.bulk_create(new_objects, batch_size=batch_size)
+
+        saved_objects = {}
+        ordering = ('sort_order', 'pk') if 'sort_order' in field_names else ('pk', )
+        for i in range(0, len(page_ids), batch_size):
+            for related_object in model._default_manager.filter(**{fk_name + '__in': page_ids[i:i + batch_size]}).\
+                    order_by(*ordering):
+                saved_objects.setdefault(getattr(related_object, fk_attname), []).append(related_object)
+
+        for page, relation_name, related_objects in relations:
+            if hasattr(getattr(page, relation_name), 'commit'):
+                setattr(page, relation_name, saved_objects.get(page.id, []))
+
+        logger.info("Inserted %d %s", len(new_objects), model._meta.verbose_name_plural)
+
+
+class BulkPublisher(object):
+    """
+    Collects pages as they are created or changed and, once everything about them (including deferred
+    relations) has been resolved, writes exactly one revision for each with bulk_create, and marks them all
+    live with a few UPDATEs. This replaces save_revision().publish(), which saves each page again, once per call,
+    and sends page_published; nothing in a bootstrap listens for that.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.pages = []
+        self.seen = set()
+
+    def add(self, page):
+        if id(page) not in self.seen:
+            self.seen.add(id(page))
+            self.pages.append(page)
+
+    def discard(self, pages):
+        """
+        Forgets pages which were rolled back, so that no revision is written for them.
+        """
+        discarded = set(id(page) for page in pages).intersection(self.seen)
+        if discarded:
+            self.seen.difference_update(discarded)
+            self.pages = [page for page in self.pages if id(page) not in discarded]
+
+    def flush(self):
+        if not self.pages:
+            return
+
+        now = timezone.now()
+        page_field_names = set(Page._meta.get_all_field_names())
+
+        revisions = []
+        for page in self.pages:
+            page.live = True
+            page.has_unpublished_changes = False
+            if 'latest_revision_created_at' in page_field_names:
+                page.latest_revision_created_at = now
+            if 'first_published_at' in page_field_names and not page.first_published_at:
+                page.first_published_at = now
+
+            revisions.append(PageRevision(page_id=page.id,
+                                          submitted_for_moderation=False,
+                                          user_id=page.owner_id,
+                                          created_at=now,
+                                          content_json=page.to_json()))
+
+        PageRevision.objects.bulk_create(revisions, batch_size=self.batch_size)
+
+        updates = {'live': True, 'has_unpublished_changes': False}
+        if 'latest_revision_created_at' in page_field_names:
+            updates['latest_revision_created_at'] = now
+
+        page_ids = [page.id for page in self.pages]
+        for i in range(0, len(page_ids), self.batch_size):
+            batch = Page.objects.filter(id__in=page_ids[i:i + self.batch_size])
+            batch.update(**updates)
+            if 'first_published_at' in page_field_names:
+                batch.filter(first_published_at__isnull=True).update(first_published_at=now)
+
+        logger.info("Published %d pages", len(self.pages))
+        self.pages = []
+        self.seen = set()
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+__author__ = 'brett@codigious.com'
+
+logger = logging.getLogger('wagtail_commons.core')
+
+
+class RenderCache(object):
+    """
+    An on-disk, content-addressed cache of rendered text. Entries are keyed by a hash of the source text and of
+    whatever configuration affects the rendering, so a stale entry can never be returned; it just stops being
+    used, and is eventually evicted. When the cache grows past max_size bytes, the least recently used entries
+    (by mtime, which is bumped on every hit) are removed until it is back under 90% of max_size.
+
+    Several processes may share a cache directory; entries are written to a temporary file and renamed into
+    place, so readers never see a partial entry.
+    """
+
+    def __init__(self, cache_dir, max_size=256 * 1024 * 1024, config=''):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.config = config
+        self.size = None
+
+    def key(self, text):
+        digest = hashlib.sha1(self.config.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def path_for_key(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key + '.html')
+
+    def get(self, text):
+        path = self.path_for_key(self.key(text))
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                value = f.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, text, value):
+        path = self.path_for_key(self.key(text))
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf8') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as ex:
+            logger.warning("Could not write to render cache %s: %s", self.cache_dir, ex)
+            return
+
+        if self.size is None:
+            self.size = self.compute_size()
+        else:
+            self.size += os.path.getsize(path)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.html'):
+                    path = os.path.join(root, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue  # evicted by another process
+                    yield stat.st_mtime, stat.st_size, path
+
+    def compute_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_size * 0.9
+
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        for _, _, path in list(self.entries()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
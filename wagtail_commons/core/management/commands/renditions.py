@@ -0,0 +1,176 @@
+import logging
+import os
+import re
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.template.base import smart_split
+
+from wagtail.wagtailimages.models import get_image_model
+
+from .utils import worker_pool
+
+__author__ = 'brett@codigious.com'
+
+logger = logging.getLogger('wagtail_commons.core')
+
+image_tag_regex = re.compile(r'\{%\s*image\s+(.+?)\s*%\}')
+
+
+def unquote(arg):
+    if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in ('"', "'"):
+        return arg[1:-1]
+    return arg
+
+
+def template_dirs():
+    dirs = list(getattr(settings, 'TEMPLATE_DIRS', ()))
+    for engine in getattr(settings, 'TEMPLATES', ()):
+        dirs.extend(engine.get('DIRS', ()))
+    for app_config in apps.get_app_configs():
+        dirs.append(os.path.join(app_config.path, 'templates'))
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def filter_spec_for_format(format_name):
+    from wagtail.wagtailimages.formats import get_image_format
+    try:
+        return get_image_format(format_name).filter_spec
+    except KeyError:
+        logger.warning("Unknown image format '%s'", format_name)
+        return None
+
+
+def filter_specs_in_text(text):
+    """
+    Yields a (filter spec, image file name) pair for each image tag in text. wagtailimages' {% image obj spec %}
+    could show any image, so its file name is None; our own {% image "file name" "format" "alt text" %} shows the
+    named file, with the filter spec of the image format.
+    """
+    for match in image_tag_regex.finditer(text):
+        args = list(smart_split(match.group(1)))
+        if len(args) > 2 and args[-2] == 'as':
+            args = args[:-2]
+
+        if len(args) == 3 and all(unquote(arg) != arg for arg in args):
+            spec = filter_spec_for_format(unquote(args[1]))
+            file_name = os.path.basename(unquote(args[0]))
+        elif len(args) == 2:
+            spec = unquote(args[1])
+            file_name = None
+        else:
+            continue
+
+        if spec:
+            yield spec, file_name
+
+
+def add_filter_spec(specs, spec, file_name):
+    if file_name is None:
+        specs[spec] = None
+    elif spec not in specs:
+        specs[spec] = {file_name}
+    elif specs[spec] is not None:
+        specs[spec].add(file_name)
+
+
+def find_filter_specs(*directories):
+    """
+    Returns the filter specs used by image tags in the files beneath directories (template directories, and the
+    content directory, whose markdown can also use template tags), as a dict of each spec to the file names of the
+    images it is used with, or to None if it may be used with any image.
+    """
+    specs = {}
+    for directory in directories:
+        for root, _, file_names in os.walk(directory):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                try:
+                    with open(path, 'r', encoding='utf8') as f:
+                        text = f.read()
+                except (IOError, UnicodeDecodeError):
+                    continue
+                for spec, file_name in filter_specs_in_text(text):
+                    add_filter_spec(specs, spec, file_name)
+    return specs
+
+
+def rendition_model():
+    related = get_image_model().renditions.related
+    return getattr(related, 'related_model', None) or related.model
+
+
+def existing_renditions(image_ids, batch_size=500):
+    Rendition = rendition_model()
+    field_names = Rendition._meta.get_all_field_names()
+    spec_field = 'filter_spec' if 'filter_spec' in field_names else 'filter__spec'
+
+    existing = set()
+    for i in range(0, len(image_ids), batch_size):
+        existing.update(Rendition.objects.filter(image_id__in=image_ids[i:i + batch_size]).
+                        values_list('image_id', spec_field))
+    return existing
+
+
+def generate_rendition(task):
+    image_id, filter_spec = task
+    try:
+        get_image_model().objects.get(pk=image_id).get_rendition(filter_spec)
+    except Exception as ex:
+        return image_id, filter_spec, str(ex)
+    return image_id, filter_spec, None
+
+
+def pregenerate_renditions(filter_specs, jobs=1, stdout=None):
+    """
+    Creates the missing renditions for filter_specs (as returned by find_filter_specs), so that the first requests
+    for a page don't have to: of every image in the library for specs used by wagtailimages' image tag, and of the
+    named images for those only used by our own. With jobs > 1 the renditions are generated by a pool of that many
+    worker processes (see worker_pool), each with its own database connection.
+
+    Returns (generated, skipped, failed, seconds).
+    """
+    images = [(image_id, os.path.basename(file_name))
+              for image_id, file_name in get_image_model().objects.values_list('id', 'file')]
+    existing = existing_renditions([image_id for image_id, _ in images])
+
+    tasks = []
+    skipped = 0
+    for spec in sorted(filter_specs):
+        file_names = filter_specs[spec]
+        for image_id, file_name in images:
+            if file_names is not None and file_name not in file_names:
+                continue
+            if (image_id, spec) in existing:
+                skipped += 1
+            else:
+                tasks.append((image_id, spec))
+
+    try:
+        from wagtail.wagtailimages.models import Filter
+    except ImportError:
+        pass
+    else:
+        # created up front, or the workers would race to create them
+        for spec in filter_specs:
+            Filter.objects.get_or_create(spec=spec)
+
+    started = time.time()
+    if jobs > 1 and len(tasks) > 1:
+        with worker_pool(jobs) as executor:
+            chunk_size = max(1, len(tasks) // (jobs * 4))
+            results = list(executor.map(generate_rendition, tasks, chunksize=chunk_size))
+    else:
+        results = [generate_rendition(task) for task in tasks]
+    seconds = time.time() - started
+
+    failed = 0
+    for image_id, spec, error in results:
+        if error:
+            failed += 1
+            logger.warning("Could not generate rendition %s of image %s: %s", spec, image_id, error)
+            if stdout:
+                stdout.write("Failed: rendition {0} of image {1} ({2})".format(spec, image_id, error))
+
+    return len(results) - failed, skipped, failed, seconds
@@ -2,10 +2,16 @@ from wagtail.wagtaildocs.models import Document
 
 __author__ = 'brett@codigious.com'
 
-import logging, os
+import logging, os, sys, threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import django
 from django.http import Http404
 from django.template import Template, Context
-from django.db import models
+from django.db import models, transaction, connections
+from django.conf import settings
+from django.apps import apps
 
 import markdown
 
@@ -21,20 +27,253 @@ except ImportError:
     def get_upload_to(instance, path):
         return instance.get_upload_to(path)
 
+from .render_cache import RenderCache
+
 logger = logging.getLogger('wagtail_commons.core')
 
 
 class BootstrapError(Exception):
     pass
 
+
+def worker_pool(jobs):
+    """
+    Returns a ProcessPoolExecutor of jobs worker processes, each with Django set up. They are forked where the
+    platform can fork, whatever its default start method is, so that they share this process' configuration;
+    elsewhere each worker calls django.setup() (from DJANGO_SETTINGS_MODULE) before its first task. This
+    process' database connections are closed first, so that no worker shares one; call it outside a transaction.
+    """
+    for connection in connections.all():
+        connection.close()
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+
+class CommitStrategy(object):
+    """
+    How a bootstrap command commits its work, given by its --commit option:
+
+    - "all" (the default): everything happens in one transaction, so a failed run changes nothing.
+    - "subtree": as "all", but each page subtree is created inside a savepoint; when one fails, it is rolled
+      back and reported, and the run carries on without it.
+    - a number N: commit after every N objects. A failed run keeps what was committed before the failing chunk.
+
+    Wrap the command's work in run(), call subtree() around each unit which may be skipped when it fails, and
+    tick() after each object is written.
+    """
+
+    ALL = 'all'
+    SUBTREE = 'subtree'
+
+    def __init__(self, strategy=None, using=None):
+        self.using = using
+        self.every = None
+        self.count = 0
+        self.block = None
+
+        if not strategy or strategy == self.ALL:
+            self.mode = self.ALL
+        elif strategy == self.SUBTREE:
+            self.mode = self.SUBTREE
+        else:
+            try:
+                self.every = int(strategy)
+            except ValueError:
+                raise BootstrapError("Unknown commit strategy '{0}', expected all, subtree or a number".
+                                     format(strategy))
+            if self.every < 1:
+                raise BootstrapError("Commit every {0} objects? Expected a positive number".format(self.every))
+            self.mode = 'every'
+
+    @property
+    def skips_failed_subtrees(self):
+        return self.mode == self.SUBTREE
+
+    @contextmanager
+    def run(self):
+        if not self.every:
+            with transaction.atomic(using=self.using):
+                yield self
+            return
+
+        self.begin()
+        try:
+            yield self
+        except:
+            self.block.__exit__(*sys.exc_info())
+            self.block = None
+            raise
+        self.commit()
+
+    @contextmanager
+    def subtree(self):
+        if self.mode == self.SUBTREE:
+            with transaction.atomic(using=self.using):
+                yield
+        else:
+            yield
+
+    def begin(self):
+        self.block = transaction.atomic(using=self.using)
+        self.block.__enter__()
+
+    def commit(self):
+        block, self.block = self.block, None
+        block.__exit__(None, None, None)
+
+    def tick(self, count=1):
+        if not self.every or self.block is None:
+            return
+
+        self.count += count
+        if self.count >= self.every:
+            self.count = 0
+            self.commit()
+            self.begin()
+
+
+@contextmanager
+def no_transaction():
+    yield
+
+
+def index_objects(model, objects):
+    """
+    Adds objects, which were written with bulk_create or _insert, to the search index, as saving them one by one
+    would have done (wagtailsearch indexes objects when post_save is sent, and bulk writes don't send it).
+    The objects must have their ids.
+    """
+    if not objects:
+        return
+
+    try:
+        from wagtail.wagtailsearch.index import Indexed
+        from wagtail.wagtailsearch.backends import get_search_backends
+    except ImportError:
+        return
+
+    if not issubclass(model, Indexed):
+        return
+
+    try:
+        backends = get_search_backends(with_auto_update=True)
+    except TypeError:
+        backends = get_search_backends()
+
+    for backend in backends:
+        backend.add_bulk(model, objects)
+
+
+class ModelTypeResolver(object):
+    """
+    Maps "app_label.model" type strings, as used by the type: attribute of pages and the file names of
+    bootstrap_models, to model classes. The table is built from the app registry the first time it is needed,
+    so resolving a type never touches the database.
+    """
+
+    def __init__(self):
+        self.models = None
+
+    def load(self):
+        self.models = {}
+        for model in apps.get_models():
+            self.models['{0}.{1}'.format(model._meta.app_label, model._meta.model_name)] = model
+
+    def resolve(self, content_type):
+        if self.models is None:
+            self.load()
+
+        try:
+            app_label, model_name = content_type.split('.')
+        except (AttributeError, ValueError):
+            raise BootstrapError("Malformed type '{0}', expected <app label>.<model>".format(content_type))
+
+        try:
+            return self.models['{0}.{1}'.format(app_label, model_name.lower())]
+        except KeyError:
+            raise BootstrapError("Unknown type '{0}'".format(content_type))
+
+
+model_types = ModelTypeResolver()
+
+
+def model_for_type(content_type):
+    return model_types.resolve(content_type)
+
+MARKDOWN_EXTENSIONS = ['extra', ]
+
+_render_cache = None
+
+
+def get_render_cache():
+    """
+    Returns the RenderCache configured by settings.BOOTSTRAP_RENDER_CACHE_DIR (and, optionally,
+    BOOTSTRAP_RENDER_CACHE_SIZE, in bytes), or None if no cache directory is configured.
+    """
+    global _render_cache
+
+    if _render_cache is None:
+        cache_dir = getattr(settings, 'BOOTSTRAP_RENDER_CACHE_DIR', None)
+        if not cache_dir:
+            return None
+
+        config = 'markdown {0} {1}'.format(getattr(markdown, 'version', ''), ','.join(MARKDOWN_EXTENSIONS))
+        _render_cache = RenderCache(cache_dir,
+                                    max_size=getattr(settings, 'BOOTSTRAP_RENDER_CACHE_SIZE', 256 * 1024 * 1024),
+                                    config=config)
+
+    return _render_cache
+
+
+_markdown_engines = threading.local()
+
+
+def get_markdown_engine():
+    """
+    Returns this thread's markdown.Markdown instance, building it (and loading its extensions) on first use.
+    An instance can't be shared between threads (live_preview runs in a threaded server), since convert() keeps
+    its state on the instance.
+    """
+    engine = getattr(_markdown_engines, 'engine', None)
+    if engine is None:
+        engine = _markdown_engines.engine = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+
+    return engine
+
+
+def has_template_syntax(text):
+    return '{%' in text or '{{' in text or '{#' in text
+
+
 def render_markdown(md):
-    rendered_markdown = Template(md).render(Context())
-    db_safe_html = markdown.markdown(rendered_markdown, extensions=['extra', ])
+    # Template tags may look things up in the database, so only the markdown conversion of their output is cached
+    if has_template_syntax(md):
+        rendered_markdown = Template(md).render(Context())
+    else:
+        rendered_markdown = md
+
+    cache = get_render_cache()
+    if cache:
+        db_safe_html = cache.get(rendered_markdown)
+        if db_safe_html is not None:
+            return db_safe_html
+
+    db_safe_html = get_markdown_engine().reset().convert(rendered_markdown)
+
+    if cache:
+        cache.set(rendered_markdown, db_safe_html)
+
     return db_safe_html
 
 
 def page_for_path(path, site=None):
     if not site:
+        page = prefetched('page', path)
+        if page is not NOT_PREFETCHED:
+            return page
         site = Site.objects.get(is_default_site=True)
 
     path_components = path.strip('/').split('/')
@@ -52,7 +291,198 @@ def identity(val):
     return val
 
 
+NOT_PREFETCHED = object()
+
+
+class ReferenceResolver(object):
+    """
+    Resolves the images, documents, pages and natural-key references of a whole import with one query per kind
+    (or per model), instead of one query per reference. Call add() for every reference found in the content,
+    then prefetch(), which returns the references that don't exist; while the resolver is active (see
+    use_reference_resolver) image_for_name, document_for_name, page_for_path and model_by_natural_key answer
+    from it. Anything it wasn't asked to prefetch falls back to a query, as before.
+
+    Pages which are part of the import are declared with expect_pages(), and registered with add_page() as they
+    are instantiated; page_for_path then finds them in memory instead of routing through the tree. Pages outside
+    the import are looked up with one query for all of them (plus one per page type), unless outside_pages is
+    False: bootstrap_content deletes every page it didn't import, so there they are reported as missing instead.
+
+    Natural-key references are fetched with an IN query on the field the key is stored in, which is given by
+    natural_key_fields (model name to field name, from the natural_keys section of relations.yml) or by a
+    natural_key_field attribute on the model. Otherwise each key is fetched with get_by_natural_key.
+    """
+
+    batch_size = 500
+
+    def __init__(self, root_url_path='/', natural_key_fields=None, outside_pages=True):
+        self.root_url_path = root_url_path
+        self.natural_key_fields = natural_key_fields or {}
+        self.outside_pages = outside_pages
+        self.requested = {}
+        self.found = {}
+        self.pages = {}
+        self.expected_pages = set()
+
+    def url_path_for(self, path):
+        # page_for_path routes from the default site's root page
+        path = path.strip('/')
+        return self.root_url_path + path + '/' if path else self.root_url_path
+
+    def expect_pages(self, url_paths):
+        self.expected_pages.update(url_paths)
+
+    def add_page(self, url_path, page):
+        self.pages[url_path] = page
+
+    def remove_page(self, url_path):
+        self.pages.pop(url_path, None)
+
+    def kind_for_transformation(self, transformation):
+        if transformation is page_for_path:
+            return 'page'
+        if transformation is image_for_name:
+            return 'image'
+        if transformation is document_for_name:
+            return 'document'
+        return getattr(transformation, 'model_class', None)
+
+    def key_for(self, kind, val):
+        if kind == 'image':
+            return os.path.basename(val)
+        if kind == 'page':
+            return self.url_path_for(val)
+        return val
+
+    def add(self, transformation, val, source=None):
+        kind = self.kind_for_transformation(transformation)
+        if kind is None or not isinstance(val, str):
+            return False
+
+        self.requested.setdefault(kind, {}).setdefault(self.key_for(kind, val), []).append(source)
+        return True
+
+    def prefetch(self):
+        missing = []
+        for kind, references in self.requested.items():
+            if kind == 'image':
+                found = self.prefetch_images(list(references))
+            elif kind == 'document':
+                found = self.prefetch_documents(list(references))
+            elif kind == 'page':
+                outside = [key for key in references if key not in self.expected_pages]
+                found = self.prefetch_pages(outside) if self.outside_pages else {}
+            else:
+                found = self.prefetch_natural_keys(kind, set(references))
+            self.found[kind] = found
+
+            label = kind if isinstance(kind, str) else kind.__name__
+            for key, sources in sorted(references.items()):
+                if key not in found and not (kind == 'page' and key in self.expected_pages):
+                    missing.append((label, key, sources))
+
+        return missing
+
+    def batches(self, keys):
+        for i in range(0, len(keys), self.batch_size):
+            yield keys[i:i + self.batch_size]
+
+    def prefetch_images(self, titles):
+        ImageModel = get_image_model()
+        found = {}
+        for batch in self.batches(titles):
+            for image in ImageModel.objects.filter(title__in=batch):
+                found.setdefault(image.title, image)
+        return found
+
+    def prefetch_documents(self, names):
+        found = {}
+        for batch in self.batches(names):
+            files = {os.path.join('documents', name): name for name in batch}
+            for document in Document.objects.filter(file__in=list(files)):
+                found[files[str(document.file)]] = document
+        return found
+
+    def prefetch_pages(self, url_paths):
+        found = {}
+        for batch in self.batches(url_paths):
+            pages_by_type = {}
+            for page in Page.objects.filter(url_path__in=batch):
+                pages_by_type.setdefault(page.content_type, []).append(page.id)
+
+            for content_type, ids in pages_by_type.items():
+                for page in content_type.model_class().objects.filter(id__in=ids):
+                    found[page.url_path] = page
+        return found
+
+    def natural_key_field(self, model_class):
+        return self.natural_key_fields.get(model_class.__name__) or getattr(model_class, 'natural_key_field', None)
+
+    def prefetch_natural_keys(self, model_class, keys):
+        found = {}
+        field = self.natural_key_field(model_class)
+
+        if field is None:
+            for key in keys:
+                try:
+                    found[key] = model_class.objects.get_by_natural_key(key)
+                except model_class.DoesNotExist:
+                    pass
+            return found
+
+        for batch in self.batches(list(keys)):
+            for instance in model_class.objects.filter(**{field + '__in': batch}):
+                found[str(getattr(instance, field))] = instance
+        return found
+
+    def get(self, kind, val):
+        if kind == 'page':
+            url_path = self.url_path_for(val)
+            page = self.pages.get(url_path)
+            if page is not None:
+                return page
+            if not self.outside_pages and url_path not in self.expected_pages:
+                return None
+        try:
+            return self.found[kind].get(self.key_for(kind, val), NOT_PREFETCHED)
+        except KeyError:
+            return NOT_PREFETCHED
+
+
+active_reference_resolver = None
+
+
+def use_reference_resolver(resolver):
+    global active_reference_resolver
+    active_reference_resolver = resolver
+
+
+def register_page(url_path, page):
+    if active_reference_resolver is not None:
+        active_reference_resolver.add_page(url_path, page)
+
+
+def unregister_page(url_path):
+    if active_reference_resolver is not None:
+        active_reference_resolver.remove_page(url_path)
+
+
+def prefetched_page(url_path):
+    if active_reference_resolver is None:
+        return None
+    return active_reference_resolver.pages.get(url_path)
+
+
+def prefetched(kind, val):
+    if active_reference_resolver is None:
+        return NOT_PREFETCHED
+    return active_reference_resolver.get(kind, val)
+
+
 def image_for_name(val):
+    image = prefetched('image', val)
+    if image is not NOT_PREFETCHED:
+        return image
+
     val = os.path.basename(val)
     ImageModel = get_image_model()
     try:
@@ -77,12 +507,19 @@ def image_for_name(val):
 def model_by_natural_key(model_class):
 
     def f(val):
+        instance = prefetched(model_class, val)
+        if instance is not NOT_PREFETCHED:
+            return instance
         return model_class.objects.get_by_natural_key(val)
 
+    f.model_class = model_class
     return f
 
 
 def document_for_name(val):
+    document = prefetched('document', val)
+    if document is not NOT_PREFETCHED:
+        return document
     return Document.objects.get(file=os.path.join('documents', val))
 
 